@@ -12,6 +12,218 @@ __version__ = "1.0"
 
 import json
 import os
+import time
+import numpy as np
+from operator import itemgetter
+
+# 7 days (in s) is the max a note can be on the market
+MAX_TIME_ON_MARKET = 7 * 24  * 3600 # 168 hours is 7 days
+
+# Order fields copied to every price point of the order
+NUMERIC_ORDER_FIELDS = ['loanRate', 'outstanding_principal', 'days_since_payment', 'ytm', 'credit_score_trend', 'markup_discount', 'asking_price', 'accrued_interest', 'remaining_pay']
+NOMINAL_ORDER_FIELDS = ['loanGrade']
+
+# Class labels, indexed by the codes convertDataColumnar computes
+NOTE_STATUS_LABELS = np.array(['NB', 'NBY', 'B', 'C'], dtype=object)
+
+# Bytes read at a time from a JSON dump
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Order fields the conversion needs, fetched from mongo
+MONGO_ORDER_FIELDS = ['loanGUID', 'noteId', 'orderId', 'first_seen', 'last_seen', 'price_history'] + NUMERIC_ORDER_FIELDS + NOMINAL_ORDER_FIELDS
+
+# Orders fetched from mongo per round trip, unless MONGO_BATCH_SIZE is set in the configuration file
+DEFAULT_MONGO_BATCH_SIZE = 1000
+
+# Name of the array holding the cache key in a converted data cache file
+CACHE_KEY_ARRAY = '__cacheKey__'
+
+
+def toFloatArray(values):
+	""" numpy float array of values, with None and 'null' as NaN """
+	try:
+		return np.array(values, dtype=float)
+	except (ValueError, TypeError):
+		return np.array([np.nan if value is None or value == 'null' else float(value) for value in values], dtype=float)
+
+
+def iterJsonArray(jsonFile, blockSize=READ_BLOCK_SIZE):
+	"""
+	Yield the items of the JSON array in jsonFile one at a time,
+	reading the file a block at a time, so only the current item and
+	one block are held in memory.
+	"""
+
+	decoder = json.JSONDecoder()
+	buf = ''
+	pos = 0
+	eof = False
+	inArray = False
+
+	while True:
+		# skip whitespace and the separators between items
+		while pos < len(buf) and (buf[pos].isspace() or (inArray and buf[pos] == ',')):
+			pos += 1
+
+		if pos < len(buf):
+			if not inArray:
+				if buf[pos] != '[':
+					raise ValueError("Expected a JSON array, found %r" % buf[pos:pos + 20])
+				inArray = True
+				pos += 1
+				continue
+			if buf[pos] == ']':
+				return
+			try:
+				item, end = decoder.raw_decode(buf, pos)
+			except ValueError:
+				if eof:
+					raise
+			else:
+				# an item that ends the buffer may be cut short (e.g. a number)
+				if end < len(buf) or eof:
+					yield item
+					pos = end
+					continue
+		elif eof:
+			raise ValueError("Unexpected end of JSON array")
+
+		block = jsonFile.read(blockSize)
+		eof = not block
+		buf = buf[pos:] + block
+		pos = 0
+
+
+def iterJsonLines(jsonFile):
+	""" Yield the JSON value on each non-blank line of jsonFile """
+	for line in jsonFile:
+		if line.strip():
+			yield json.loads(line)
+
+
+def parseTimestampFromDate(yyyyMmDd):
+	""" Timestamp of a 'YYYY-MM-DD' date (as the Downloader stores first_seen / last_seen), or None """
+	if not yyyyMmDd:
+		return None
+	return int(time.mktime(time.strptime(yyyyMmDd.split(' ')[0], '%Y-%m-%d')))
+
+
+def connectToMongo(host, port):
+	""" MongoClient for the Downloader's database; pymongo is only needed to read from it """
+	try:
+		from pymongo import MongoClient
+	except ImportError, error:
+		print "pymongo is needed to read Downloader data from mongo: %s " % repr(error)
+		exit(1)
+	return MongoClient(host, port)
+
+
+def mongoOrderQuery(startTime=None, endTime=None):
+	""" Query for the orders first seen at or after startTime and last seen before endTime (either can be None) """
+	query = {}
+	if startTime is not None:
+		query['first_seen'] = {'$gte': startTime}
+	if endTime is not None:
+		query['last_seen'] = {'$lt': endTime}
+	return query
+
+
+def saveColumnarCache(data, cachePath, cacheKey):
+	"""
+	Save ColumnarData to a numpy .npz file, tagged with cacheKey (a JSON
+	string describing where the data came from).
+
+	Nominal columns are stored as numpy string arrays rather than pickled
+	objects, unless they hold None.
+	"""
+
+	arrays = {CACHE_KEY_ARRAY: np.array(cacheKey)}
+	for name, column in data.columns.iteritems():
+		if column.dtype == object and len(column):
+			packed = np.array(column.tolist())
+			if packed.dtype.kind in 'SU':
+				column = packed
+		arrays[name] = column
+
+	# np.savez wants a .npz name; write it aside and rename it, so an interrupted run never leaves half a cache
+	tmpPath = '%s.%d.tmp.npz' % (cachePath, os.getpid())
+	np.savez_compressed(tmpPath, **arrays)
+	os.rename(tmpPath, cachePath)
+
+
+def loadColumnarCache(cachePath, cacheKey):
+	"""
+	Load ColumnarData saved by saveColumnarCache.
+
+	@return the ColumnarData, or None if there is no cache file or it was saved with another cacheKey
+	"""
+
+	if not cachePath or not os.path.exists(cachePath):
+		return None
+
+	try:
+		archive = np.load(cachePath, allow_pickle=True)
+	except TypeError:	# numpy < 1.10 has no allow_pickle
+		archive = np.load(cachePath)
+
+	try:
+		if archive[CACHE_KEY_ARRAY].item() != cacheKey:
+			return None
+		columns = {}
+		for name in archive.files:
+			if name == CACHE_KEY_ARRAY:
+				continue
+			column = archive[name]
+			if column.dtype.kind in 'SU':
+				column = column.astype(object)
+			columns[name] = column
+	finally:
+		archive.close()
+
+	return ColumnarData(columns)
+
+
+class ColumnarData(object):
+	"""
+	Converted Downloader data as a dict of numpy arrays, one array per
+	attribute and one row per price point: the same rows as the dicts of
+	Converter.convertData, without building a dict per row.
+
+	Numeric columns are float arrays, with NaN where the raw data had
+	'null'. Nominal columns ('id', 'loanGrade', 'noteStatus') are object
+	arrays of the raw values.
+	"""
+
+	def __init__(self, columns):
+		self.columns = columns
+
+	def __len__(self):
+		return len(self.columns['noteStatus'])
+
+	def __getitem__(self, attributeName):
+		return self.columns[attributeName]
+
+	def __contains__(self, attributeName):
+		return attributeName in self.columns
+
+	def classMask(self, noteStatus):
+		""" Boolean mask of the rows of class noteStatus """
+		return self.columns['noteStatus'] == noteStatus
+
+	def select(self, mask):
+		""" The rows selected by a boolean mask (or index array) """
+		return ColumnarData(dict((name, column[mask]) for name, column in self.columns.iteritems()))
+
+	def row(self, i):
+		""" Row i as a dict, as convertData would have built it """
+		datapoint = {}
+		for name, column in self.columns.iteritems():
+			value = column[i]
+			if isinstance(value, np.floating):
+				value = None if np.isnan(value) else float(value)
+			datapoint[name] = value
+		return datapoint
+
 
 class Converter(object):
 	"""Converter for Downloader Data"""
@@ -35,9 +247,116 @@ class Converter(object):
 			print "Missing key %s in the configufation file"
 
 	def loadDataFromFile(self, filePath):
-		""" Load Downloader data from file """
-		f = open(filePath, 'r')
-		return json.load(f)
+		"""
+		Load Downloader data from file, one order at a time.
+
+		The file is either a JSON array of orders, or newline-delimited JSON
+		with one order per line; the first character tells them apart.
+
+		@return a generator of orders
+		"""
+		with open(filePath, 'r') as f:
+			firstChar = ''
+			while True:
+				firstChar = f.read(1)
+				if not firstChar or not firstChar.isspace():
+					break
+			f.seek(0)
+
+			if firstChar == '[':
+				orders = iterJsonArray(f)
+			else:
+				orders = iterJsonLines(f)
+
+			for order in orders:
+				yield order
+
+	def loadDataFromMongo(self, host, port, dbName, startTime=None, endTime=None, batchSize=DEFAULT_MONGO_BATCH_SIZE):
+		"""
+		Load Downloader data straight from the Downloader's orders collection, one order at a time.
+
+		Only the orders first seen at or after startTime and last seen before endTime are read
+		(either bound can be None), and only the fields the conversion needs; they are fetched
+		batchSize orders per round trip.
+
+		@return a generator of orders
+		"""
+		fields = dict((name, True) for name in MONGO_ORDER_FIELDS)
+		fields['_id'] = False
+
+		client = connectToMongo(host, port)
+		try:
+			for order in client[dbName].orders.find(mongoOrderQuery(startTime, endTime), fields).batch_size(batchSize):
+				yield order
+		finally:
+			client.close()
+
+	def mongoDataVersion(self, host, port, dbName, startTime=None, endTime=None):
+		"""
+		What the orders loadDataFromMongo would read currently look like: their number and
+		their latest last_seen. The Downloader bumps last_seen whenever it sees an order,
+		so new or updated orders change one or the other.
+
+		@return [count, max last_seen]
+		"""
+		client = connectToMongo(host, port)
+		try:
+			orders = client[dbName].orders
+			query = mongoOrderQuery(startTime, endTime)
+			latest = list(orders.find(query, {'last_seen': True, '_id': False}).sort('last_seen', -1).limit(1))
+			return [orders.find(query).count(), latest[0]['last_seen'] if latest else None]
+		finally:
+			client.close()
+
+	def convertDataFromSource(self, fileToConvert, columnar=False):
+		"""
+		Load and convert Downloader data from the source set in the configuration file:
+		fileToConvert if DATA_SOURCE is 'file' (the default), the Downloader's database if it is 'mongo'.
+
+		If CONVERTED_DATA_CACHE is set, columnar data is saved there, and reused by later runs
+		reading the same unchanged data (same file, size and modification time, or same database,
+		time window, number of orders and latest last_seen) with the same classes.
+		"""
+		conf = globals()
+		dataSource = conf.get('DATA_SOURCE', 'file')
+
+		if dataSource == 'mongo':
+			host = conf.get('MONGO_HOST', 'localhost')
+			port = int(conf.get('MONGO_PORT', 27017))
+			dbName = conf.get('MONGO_DBNAME', 'lendingclub')
+			startTime = parseTimestampFromDate(conf.get('MONGO_START_DATE'))
+			endTime = parseTimestampFromDate(conf.get('MONGO_END_DATE'))
+			batchSize = int(conf.get('MONGO_BATCH_SIZE', DEFAULT_MONGO_BATCH_SIZE))
+			source = ['mongo', host, port, dbName, startTime, endTime]
+			dataVersion = lambda: self.mongoDataVersion(host, port, dbName, startTime, endTime)
+			loadData = lambda: self.loadDataFromMongo(host, port, dbName, startTime, endTime, batchSize)
+		elif dataSource == 'file':
+			# a changed file has another size or modification time
+			filePath = os.path.abspath(fileToConvert)
+			source = ['file', filePath]
+			dataVersion = lambda: [os.path.getsize(filePath), os.path.getmtime(filePath)]
+			loadData = lambda: self.loadDataFromFile(filePath)
+		else:
+			print "Unknown DATA_SOURCE %r in the configuration file" % dataSource
+			exit(1)
+
+		if not columnar:
+			return self.convertData(loadData())
+
+		cachePath = conf.get('CONVERTED_DATA_CACHE')
+		if not cachePath:
+			return self.convertDataColumnar(loadData())
+
+		# the cache is stale once the data changed
+		cacheKey = json.dumps(source + dataVersion() + [sorted(self.classes)])
+		convertedData = loadColumnarCache(cachePath, cacheKey)
+		if convertedData is not None:
+			print "==> Converted data loaded from cache %s" % cachePath
+			return convertedData
+
+		convertedData = self.convertDataColumnar(loadData())
+		saveColumnarCache(convertedData, cachePath, cacheKey)
+		return convertedData
 
 
 	def convertData(self, dataToConvert):
@@ -53,7 +372,14 @@ class Converter(object):
 		@return convertedData json file with converted data
 		"""
 
-		convertedData = []
+		return list(self.iterConvertedData(dataToConvert))
+
+	def iterConvertedData(self, dataToConvert):
+		"""
+		Same conversion as convertData, yielding each converted data point
+		as soon as it is built, so a generator of orders (see
+		loadDataFromFile) is converted in constant memory.
+		"""
 
 		for datapoint in dataToConvert:
 
@@ -112,21 +438,104 @@ class Converter(object):
 					
 				if noteStatus in self.classes:
 					newDatapoint['noteStatus'] = noteStatus
-					convertedData.append(newDatapoint)
+					yield newDatapoint
 
-		return convertedData
 
+	def convertDataColumnar(self, dataToConvert):
+		"""
+		Same conversion as convertData, into a ColumnarData.
 
-	def convertDataFromFile(self, fileToConvert):
-		""" Load file and converter Downloader data """
+		Each order is visited once, to collect its fields and price history;
+		the order fields are then repeated over its price points, and the
+		class labels are computed for all price points at once.
+
+		@param dataToConvert the json data from Downloader API
+
+		@return ColumnarData with one row per price point
+		"""
+
+		orderFieldNames = ['loanGUID', 'noteId', 'orderId', 'first_seen', 'last_seen'] + NUMERIC_ORDER_FIELDS + NOMINAL_ORDER_FIELDS
+		getOrderFields = itemgetter(*orderFieldNames)
+
+		orderRows = []
+		pointCounts = []
+		notePrices = []
+		timestamps = []
+
+		for datapoint in dataToConvert:
+			notePriceHistory = datapoint['price_history']
+			if not notePriceHistory:
+				continue
+
+			orderRows.append(getOrderFields(datapoint))
+			prices, times = zip(*notePriceHistory)
+			pointCounts.append(len(prices))
+			notePrices.extend(prices)
+			timestamps.extend(times)
+
+		orderValues = dict(zip(orderFieldNames, zip(*orderRows) or [()] * len(orderFieldNames)))
+		pointCounts = np.array(pointCounts, dtype=int)
+
+		# the triple (loanGUID, noteId, orderId) is unique for each note
+		ids = ["%s-%s-%s" % orderId for orderId in zip(orderValues['loanGUID'], orderValues['noteId'], orderValues['orderId'])]
+		firstSeen = [float(value) for value in orderValues['first_seen']]
+		lastSeen = orderValues['last_seen']
+
+		def perPricePoint(values, dtype=None):
+			""" Repeat an order's value for each of its price points """
+			if dtype is object:
+				array = np.empty(len(values), dtype=object)
+				array[:] = values
+			else:
+				array = toFloatArray(values)
+			return np.repeat(array, pointCounts)
+
+		lastSeen = toFloatArray(lastSeen)
+		timeOnMarket = perPricePoint(lastSeen - np.array(firstSeen, dtype=float))
+		timestamps = toFloatArray(timestamps)
+
+		# 'noteStatus' is the class attribute, see convertData
+		onMarket = timeOnMarket < MAX_TIME_ON_MARKET
+		lastPricePoint = timestamps == np.repeat(lastSeen, pointCounts)
+		statusCodes = np.zeros(len(timestamps), dtype=np.int8)	# NB
+		statusCodes[onMarket] = 1	# NBY
+		statusCodes[onMarket & lastPricePoint] = 2	# B
+		statusCodes[onMarket & lastPricePoint & (timeOnMarket == 0)] = 3	# C
+		noteStatus = NOTE_STATUS_LABELS[statusCodes]
+
+		columns = {
+			'id': perPricePoint(ids, object),
+			'timestamp': timestamps,
+			'notePrice': toFloatArray(notePrices),
+			'timeOnMarket': timeOnMarket / 3600,
+			'noteStatus': noteStatus,
+		}
+		for name in NUMERIC_ORDER_FIELDS:
+			columns[name] = perPricePoint(orderValues[name])
+		for name in NOMINAL_ORDER_FIELDS:
+			columns[name] = perPricePoint(orderValues[name], object)
+
+		wantedCodes = [code for code, label in enumerate(NOTE_STATUS_LABELS) if label in self.classes]
+		data = ColumnarData(columns)
+		return data.select(np.in1d(statusCodes, wantedCodes))
+
+	def convertDataFromFile(self, fileToConvert, columnar=False):
+		""" Load file and converter Downloader data, into a ColumnarData if columnar is set """
 		dataToConvert = self.loadDataFromFile(fileToConvert)
+		if columnar:
+			return self.convertDataColumnar(dataToConvert)
 		return self.convertData(dataToConvert)
 
 	def dumpData(self, data, filePath):
-		""" Dumps data to file """
+		""" Dumps data to file, as a JSON array written one item at a time (data can be a generator) """
 
 		file = open (filePath, 'w')
-		file.write(json.dumps(data))
+		file.write('[')
+		for i, datapoint in enumerate(data):
+			if i:
+				file.write(', ')
+			file.write(json.dumps(datapoint))
+		file.write(']')
 		file.close()
 
 
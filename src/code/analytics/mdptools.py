@@ -11,6 +11,7 @@ __version__ = "1.0"
 
 import mdp
 import numpy as np
+from api_converter import ColumnarData
 
 class MDPTools(object):
 	"""MDP tools for data processing"""
@@ -34,8 +35,12 @@ class MDPTools(object):
 		   				[id, notePrice, timeOnMarket, noteStatus],
 		   				  ...
 		   				[id, notePrice, timeOnMarket, noteStatus]) 
+		* A ColumnarData already holds the columns, which are stacked as they are.
 		"""
 
+		if isinstance(convertedApiData, ColumnarData):
+			return np.column_stack((convertedApiData['notePrice'], convertedApiData['timeOnMarket']))
+
 		convertedDataset = []
 		for datapoint in convertedApiData:
 			#import ipdb; ipdb.set_trace();
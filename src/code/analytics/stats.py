@@ -13,7 +13,7 @@ __version__ = "1.0"
 import json
 import scipy
 from prettytable import PrettyTable
-from api_converter import Converter
+from api_converter import ColumnarData, Converter, toFloatArray
 import numpy as np
 import mdp
 import time
@@ -45,23 +45,40 @@ class SimpleStats(object):
 			print "Missing key %s in the configufation file"
 
 	def prepareTimeseries(self, dataset,  classes, metrics):
-		"""Prepare timeserie for each metric per class"""
+		"""
+		Prepare timeserie for each metric per class: a numpy array of the non-null values
+		of the metric for the datapoints with that noteStatus.
 
-		timeseries = {}
-		for status in classes: # each class has a status => N, NB, C, E
-			timeseries[status] = {} 
+		A list of datapoints is read once, into a column per metric, and grouped like a ColumnarData.
+		"""
 
-		for status in timeseries:
-			for metricName in metrics:
-				timeseries[status][metricName] = []
+		if not isinstance(dataset, ColumnarData):
+			noteStatus = []
+			columns = dict((metricName, []) for metricName in metrics)
+			metricColumns = columns.items()
+			for datapoint in dataset:
+				noteStatus.append(datapoint['noteStatus'])
+				for metricName, column in metricColumns:
+					column.append(datapoint[metricName])
+
+			for metricName, column in metricColumns:
+				columns[metricName] = toFloatArray(column)
+			columns['noteStatus'] = np.empty(len(noteStatus), dtype=object)
+			columns['noteStatus'][:] = noteStatus
+			dataset = ColumnarData(columns)
 
-		for datapoint in dataset:
-			for status in timeseries:
-				if datapoint['noteStatus'] == status:
-					for metricName in metrics:
-						if str(datapoint[metricName]) != 'null':
-							value = float(str(datapoint[metricName]))
-							timeseries[status][metricName].append(value)
+		return self.prepareColumnarTimeseries(dataset, classes, metrics)
+
+	def prepareColumnarTimeseries(self, dataset, classes, metrics):
+		"""Same as prepareTimeseries for a ColumnarData: each class is selected with one mask, shared by its metrics"""
+
+		timeseries = {}
+		for status in classes:
+			timeseries[status] = {}
+			classMask = dataset.classMask(status)
+			for metricName in metrics:
+				values = dataset[metricName][classMask]
+				timeseries[status][metricName] = values[~np.isnan(values)]
 
 		return timeseries
 
@@ -87,7 +104,7 @@ class SimpleStats(object):
 
 
 
-	def outputMainMetricsBuckets(self, dataset,  classes, metrics, maxNbBuckets):
+	def outputMainMetricsBuckets(self, dataset,  classes, metrics, maxNbBuckets, timeseries=None):
 		""" 
 		Ouput main metric buckets for each class in the dataset.
 		This is a dimensionality reduction step :
@@ -101,13 +118,15 @@ class SimpleStats(object):
 		@param classes The class labels of the dataset
 		@param metrics The metrics names (or attributes, or columns) of the dataset
 		@param mainMetricBuckets The max nb of buckets that will be generated for each continuous metric of the dataset (the goal being to discretize them)
+		@param timeseries The timeseries of prepareTimeseries, if already computed
 
 		"""
 
 		print 
 		print "==> Main metric buckets for each class of the dataset :"
 
-		timeseries = self.prepareTimeseries(dataset, classes, metrics)
+		if timeseries is None:
+			timeseries = self.prepareTimeseries(dataset, classes, metrics)
 
 		for status in timeseries:
 			for metricName in timeseries[status]:
@@ -134,11 +153,7 @@ class SimpleStats(object):
 		population = len(timeserie)
 		buckets = {}
 		if population > maxNbBuckets:
-			dim1_matrix = []
-			for value in timeserie:
-				dim1_matrix.append([value])
-
-			data = np.array(dim1_matrix)
+			data = np.asarray(timeserie, dtype=float).reshape(-1, 1)
 			#import ipdb; ipdb.set_trace();
 			
 			kmeansNode = mdp.nodes.KMeansClassifier(maxNbBuckets)
@@ -147,11 +162,9 @@ class SimpleStats(object):
 			clusters = kmeansNode.label(data)
 			nbClusters = len(set(clusters))
 			
+			clusters = np.asarray(clusters)
 			for k in xrange(nbClusters):
-				buckets[k] = []
-				for i in xrange(len(data)):
-					if clusters[i] == k:				
-						buckets[k].append(data[i][0])		
+				buckets[k] = data[clusters == k, 0]
 
 
 
@@ -159,10 +172,11 @@ class SimpleStats(object):
 
 
 
-	def outputStats(self, dataset, classes, metrics, units):
-		"""Output mean of each metric per class and some other basic stats"""
+	def outputStats(self, dataset, classes, metrics, units, timeseries=None):
+		"""Output mean of each metric per class and some other basic stats (timeseries as in outputMainMetricsBuckets)"""
 
-		timeseries = self.prepareTimeseries(dataset, classes, metrics)
+		if timeseries is None:
+			timeseries = self.prepareTimeseries(dataset, classes, metrics)
 
 		print 
 		print "==> Simple stats :" 
@@ -191,7 +205,10 @@ class SimpleStats(object):
 
 		sampling_rate = 10
 		for i in xrange( int(len(dataset) / sampling_rate)):
-			datapoint = dataset[i * sampling_rate]
+			if isinstance(dataset, ColumnarData):
+				datapoint = dataset.row(i * sampling_rate)
+			else:
+				datapoint = dataset[i * sampling_rate]
 			pt.add_row([datapoint['id'], datapoint['timestamp'], datapoint['notePrice'], datapoint['timeOnMarket'], datapoint['noteStatus']])
 
 		print 
@@ -209,15 +226,17 @@ class SimpleStats(object):
 		 units,
 		 maxNbBuckets) = self.read_conf(self.conf_file_name)
 
-		# convert raw API data file
-		converter = Converter()
-		rawData = converter.loadDataFromFile(dataFileToConvert)
-		convertedData = converter.convertData(rawData)
+		# convert raw API data, from the file or the Downloader's database (see DATA_SOURCE)
+		converter = Converter(self.conf_file_name)
+		convertedData = converter.convertDataFromSource(dataFileToConvert, columnar=True)
+
+		# group the metrics by class once, for all the stats
+		timeseries = self.prepareTimeseries(convertedData, classes, metrics)
 
 		# output various stats
 		self.outputDatasetClassDescription(classes)
-		self.outputStats(convertedData, classes, metrics, units )
-		self.outputMainMetricsBuckets(convertedData, classes, metrics, maxNbBuckets)
+		self.outputStats(convertedData, classes, metrics, units, timeseries)
+		self.outputMainMetricsBuckets(convertedData, classes, metrics, maxNbBuckets, timeseries)
 		self.outputSamples(convertedData)
 
 		
@@ -10,7 +10,8 @@ __email__ = "kangarup@gmail.com"
 __version__ = "1.0"
 
 import arff
-from api_converter import Converter
+from api_converter import ColumnarData, Converter
+import numpy as np
 import os
 
 class WekaConverter(object):
@@ -82,6 +83,9 @@ class WekaConverter(object):
 			 	{'timeOnMarket': 3438.052265882492, 'timestamp': 1378792923.871444, 'notePrice': 3.04, 'id': '596513-2703872-11430858', 'noteStatus': 'B'}
 		"""
 
+		if isinstance(apiDataConverted, ColumnarData):
+			return self.prepareColumnarWekaData(apiDataConverted, numericAttributesNames, nominalAttributesNames)
+
 		wekaData = []
 		for datapoint in apiDataConverted:
 			wekaDatapoint = []
@@ -104,11 +108,25 @@ class WekaConverter(object):
 
 		return wekaData
 
+	def prepareColumnarWekaData(self, apiDataConverted, numericAttributesNames, nominalAttributesNames):
+		""" Same as prepareWekaData for a ColumnarData, building the rows straight from its columns """
+
+		columns = []
+		for attributesName in numericAttributesNames:
+			if attributesName in apiDataConverted:
+				column = apiDataConverted[attributesName]
+				columns.append([None if isnan else value for value, isnan in zip(column.tolist(), np.isnan(column).tolist())])
+		for attributesName in nominalAttributesNames:
+			if attributesName in apiDataConverted:
+				columns.append([None if value == 'null' else str(value) for value in apiDataConverted[attributesName]])
+
+		return [list(row) for row in zip(*columns)]
+
 	def convertToWeka(self, fileToConvert, classNominalValues, loanGradeNominalValues, numericAttributesNames, nominalAttributesNames, wekaFile):
 		""" Generate Weka ARFF file from API downloader data"""
 
-		converter = Converter()
-		apiDataConverted = converter.convertDataFromFile(fileToConvert)
+		converter = Converter(self.conf_file_name)
+		apiDataConverted = converter.convertDataFromSource(fileToConvert, columnar=True)
 
 		data = self.prepareWekaData(apiDataConverted, numericAttributesNames, nominalAttributesNames)
 
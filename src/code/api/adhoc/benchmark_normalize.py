@@ -0,0 +1,96 @@
+"""
+Benchmark the memoized parse_loan_status / map_message against the
+original uncached versions (recompiling or re-searching their regexes on
+every call), checking that both give the same results.
+
+The inputs are drawn from the kinds of strings found in the loan stats
+CSV and on note pages. From the repository root:
+
+ PYTHONPATH=`pwd` python adhoc/benchmark_normalize.py --count 500000
+"""
+import argparse
+import logging
+import random
+import re
+import time
+
+from data_model import KNOWN_STATUSES, parse_loan_status
+from lc_parser import map_message
+
+LOAN_STATUSES = [
+    'Current', 'Fully Paid', 'Charged Off', 'Late (31-120 days)',
+    'In Grace Period', 'Late (16-30 days)', 'Default', 'Issued',
+    'Does not meet the credit policy.  Status:Fully Paid',
+    'Does not meet the current credit policy.  Status:Charged Off',
+]
+
+MESSAGES = [
+    'Called borrower - no message left', 'Called borrower - message left',
+    'Left voicemail', 'Initial payment reminder', 'Sent email to borrower',
+    'Borrower contacted and promised to pay', 'Referred to legal action',
+    'Payment processed',
+]
+
+
+def original_parse_loan_status(loan_status):
+    credit_policy_re = re.compile(
+        'does not meet the (current )?credit policy.( )+status:', re.I)
+
+    if loan_status and loan_status != '':
+        if credit_policy_re.search(loan_status):
+            loan_status = credit_policy_re.sub('', loan_status)
+
+        loan_status = loan_status.lower()
+        if loan_status in list(KNOWN_STATUSES):
+            return loan_status
+        else:
+            return "unknown status"
+    return None
+
+
+def original_map_message(data):
+    if (re.search(r'no message left|no voicemail', data)):
+        return 'no message left'
+    elif (re.search(r'message left|left voicemail', data)):
+        return 'message left'
+    elif (re.search(r'legal action', data)):
+        return 'legal action'
+    elif (re.search(r'Initial payment reminder|email sent|[Ss]ent email', data)):
+        return 'payment reminder'
+    elif (re.search(r'[Bb]orrower (contacted|informed) | promised | agreed', data)):
+        return 'borrower agreed'
+    else:
+        return data
+
+
+def benchmark(name, original_fn, memoized_fn, inputs):
+    timings = []
+    for fn in (original_fn, memoized_fn):
+        start = time.time()
+        results = [fn(value) for value in inputs]
+        timings.append(time.time() - start)
+
+    assert results == [original_fn(value) for value in inputs], \
+        '%s results differ' % name
+
+    stats = memoized_fn.cache.stats()
+    print '%s: original %.2f us/call, memoized %.2f us/call (%.1fx); ' \
+        'cache hit rate %.1f%%, %d entries' % (
+            name, timings[0] * 1e6 / len(inputs), timings[1] * 1e6 / len(inputs),
+            timings[0] / timings[1], stats['hit_rate'] * 100, stats['size'])
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--count', type=int, default=200000)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    random.seed(args.seed)
+
+    benchmark('parse_loan_status', original_parse_loan_status,
+              parse_loan_status,
+              [random.choice(LOAN_STATUSES) for i in xrange(args.count)])
+    benchmark('map_message', original_map_message, map_message,
+              [random.choice(MESSAGES) for i in xrange(args.count)])
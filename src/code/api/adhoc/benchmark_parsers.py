@@ -0,0 +1,46 @@
+"""
+Benchmark the note/loan page parsers against saved pages, comparing the
+region-skipping parse (fast=True) with a full-page parse (fast=False) and
+checking that both produce the same get_info().
+
+Save a few pages from the site first (browseNotesLoanPerf.action for notes,
+loanDetail.action for loans), then from the repository root:
+
+ PYTHONPATH=`pwd` python adhoc/benchmark_parsers.py --note note1.html --loan loan.html
+"""
+import argparse
+import time
+
+from lc_parser import LoanHTMLParser, NoteHTMLParser
+
+
+def benchmark(parser_cls, pages, repeat):
+    timings = {}
+    for fast in (False, True):
+        start = time.time()
+        for i in xrange(repeat):
+            for page in pages:
+                parser_cls(page, fast=fast)
+        timings[fast] = (time.time() - start) / (repeat * len(pages))
+
+    for page in pages:
+        assert parser_cls(page, fast=True).get_info() == \
+            parser_cls(page, fast=False).get_info(), 'get_info() differs'
+
+    print '%s: full %.2f ms/page, fast %.2f ms/page (%.1fx)' % (
+        parser_cls.__name__, timings[False] * 1000, timings[True] * 1000,
+        timings[False] / timings[True])
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--note', nargs='*', default=[])
+    arg_parser.add_argument('--loan', nargs='*', default=[])
+    arg_parser.add_argument('--repeat', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    for parser_cls, filenames in ((NoteHTMLParser, args.note),
+                                  (LoanHTMLParser, args.loan)):
+        if filenames:
+            pages = [open(filename).read() for filename in filenames]
+            benchmark(parser_cls, pages, args.repeat)
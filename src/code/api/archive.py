@@ -0,0 +1,114 @@
+""" On-disk archive of raw responses, for re-parsing without re-crawling
+
+Layout under the archive root:
+    objects/ab/abcdef....gz - gzipped response bodies, named by the SHA-1
+                              of their content (identical pages are
+                              stored once)
+    index.jsonl - one JSON line per archived response: request key, url,
+                  params, fetch timestamp and content SHA-1
+
+The request key is a hash of the url plus its sorted params, minus params
+that change on every request (ARCHIVE_IGNORED_PARAMS), so the same request
+made at different times maps to the same key.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from urllib import urlencode
+
+# Cache-busting params that should not be part of the request key
+ARCHIVE_IGNORED_PARAMS = ('newrdnnum',)
+
+INDEX_FILENAME = 'index.jsonl'
+OBJECTS_DIRNAME = 'objects'
+
+
+def request_key(url, params):
+    params = sorted((k, v) for k, v in (params or {}).iteritems()
+                    if k not in ARCHIVE_IGNORED_PARAMS)
+    return hashlib.sha1(url + '?' + urlencode(params, True)).hexdigest()
+
+
+class ResponseArchive(object):
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, INDEX_FILENAME)
+        self.lock = threading.Lock()
+        self.index = None   # request key -> [(timestamp, sha1)], loaded lazily
+
+        objects_dir = os.path.join(root, OBJECTS_DIRNAME)
+        if not os.path.exists(objects_dir):
+            os.makedirs(objects_dir)
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, OBJECTS_DIRNAME, digest[:2],
+                            digest + '.gz')
+
+    def _load_index(self):
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    index.setdefault(entry['key'], []).append(
+                        (entry['timestamp'], entry['sha1']))
+        for entries in index.itervalues():
+            entries.sort()
+        logging.info('Loaded archive index of %d requests from %s',
+                     len(index), self.index_path)
+        return index
+
+    def store(self, url, params, body, timestamp=None):
+        """ Archive the body of a response to url with params """
+        timestamp = timestamp or time.time()
+        digest = hashlib.sha1(body).hexdigest()
+        key = request_key(url, params)
+
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            if not os.path.exists(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass    # another thread got there first
+            tmp_path = '%s.%s.tmp' % (path, threading.current_thread().ident)
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.rename(tmp_path, path)
+
+        entry = {
+            'key': key,
+            'url': url,
+            'params': dict((k, v) for k, v in (params or {}).iteritems()
+                           if k not in ARCHIVE_IGNORED_PARAMS),
+            'timestamp': timestamp,
+            'sha1': digest,
+        }
+        with self.lock:
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            if self.index is not None:
+                self.index.setdefault(key, []).append((timestamp, digest))
+
+    def lookup(self, url, params, as_of=None):
+        """ Body of the latest archived response to url with params,
+        fetched no later than as_of if given.
+
+        Returns: the body, or None if nothing matching was archived
+        """
+        with self.lock:
+            if self.index is None:
+                self.index = self._load_index()
+            entries = self.index.get(request_key(url, params), [])
+
+        for timestamp, digest in reversed(entries):
+            if as_of is None or timestamp <= as_of:
+                with gzip.open(self._object_path(digest), 'rb') as f:
+                    return f.read()
+        return None
@@ -14,6 +14,9 @@ auth_config = staticconf.NamespaceGetters(auth_namespace)
 lc_username = auth_config.get_string('lendingclub.username', None)
 lc_password = auth_config.get_string('lendingclub.password', None)
 
+# Extra accounts for sharded crawls, as a list of {username: .., password: ..}
+lc_accounts = auth_config.get_list('lendingclub.accounts', [])
+
 
 def load_authfile(authfile):
     try:
@@ -21,3 +24,14 @@ def load_authfile(authfile):
         logging.info("Loaded authfile: %s", authfile)
     except Exception as e:
         logging.warning("Failed to load authfile %s: %s", authfile, e)
+
+
+def load_accounts():
+    """ (username, password) of every account in the authfile: those listed
+    under lendingclub.accounts, or else the single lendingclub.username
+    """
+    accounts = [(account['username'], account['password'])
+                for account in lc_accounts.value]
+    if not accounts and lc_username.value:
+        accounts.append((lc_username.value, lc_password.value))
+    return accounts
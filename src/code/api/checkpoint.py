@@ -0,0 +1,130 @@
+""" Checkpoints that let an interrupted crawl pick up where it stopped
+
+A checkpoint records, per crawl id:
+    offset - how far the crawl has durably got (a page offset for
+             download_data, the last written note_id for
+             download_note_details)
+    in_flight - note ids being fetched but not yet written to mongo
+    updated - when the checkpoint was last saved
+
+Checkpoints live either in a local JSON file (FileCheckpointStore) or in
+a mongo collection (MongoCheckpointStore); both have the same interface.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+CHECKPOINT_COLLECTION = 'checkpoints'
+
+
+class FileCheckpointStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _write(self, checkpoints):
+        # Write a temp file and rename it, so a crash never leaves half a file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoints, f)
+        os.rename(tmp_path, self.path)
+
+    def load(self, crawl_id):
+        with self.lock:
+            return self._read().get(crawl_id)
+
+    def save(self, crawl_id, state):
+        with self.lock:
+            checkpoints = self._read()
+            checkpoints[crawl_id] = state
+            self._write(checkpoints)
+
+    def clear(self, crawl_id):
+        with self.lock:
+            checkpoints = self._read()
+            if checkpoints.pop(crawl_id, None) is not None:
+                self._write(checkpoints)
+
+
+class MongoCheckpointStore(object):
+
+    def __init__(self, db, collection=CHECKPOINT_COLLECTION):
+        self.collection = db[collection]
+
+    def load(self, crawl_id):
+        document = self.collection.find_one({'_id': crawl_id})
+        if document:
+            document.pop('_id')
+        return document
+
+    def save(self, crawl_id, state):
+        self.collection.update({'_id': crawl_id}, state, upsert=True)
+
+    def clear(self, crawl_id):
+        self.collection.remove({'_id': crawl_id})
+
+
+class CrawlCheckpoint(object):
+    """ Progress of a single crawl, saved to `store` whenever it changes.
+    With store=None progress is tracked but not persisted.
+
+    Args:
+        store: FileCheckpointStore, MongoCheckpointStore or None
+        crawl_id (str): identifies the crawl within the store
+        resume (bool): start from the stored checkpoint, if there is one
+        offset: starting offset when not resuming
+    """
+
+    def __init__(self, store, crawl_id, resume=False, offset=0):
+        self.store = store
+        self.crawl_id = crawl_id
+        self.offset = offset
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+        state = store.load(crawl_id) if store and resume else None
+        if state:
+            self.offset = state['offset']
+            logging.info('Resuming crawl %s from offset %s (checkpoint of %s); '
+                         '%d note(s) were in flight: %s',
+                         crawl_id, self.offset, time.ctime(state['updated']),
+                         len(state['in_flight']), state['in_flight'])
+        elif resume:
+            logging.info('No checkpoint for crawl %s, starting from scratch',
+                         crawl_id)
+
+    def _save(self):
+        if self.store:
+            self.store.save(self.crawl_id, {
+                'crawl_id': self.crawl_id,
+                'offset': self.offset,
+                'in_flight': sorted(self.in_flight),
+                'updated': time.time(),
+            })
+
+    def start(self, note_ids):
+        """ note_ids are being fetched """
+        with self.lock:
+            self.in_flight.update(note_ids)
+            self._save()
+
+    def complete(self, offset, note_ids):
+        """ note_ids are safely written; the crawl has got up to offset """
+        with self.lock:
+            self.in_flight.difference_update(note_ids)
+            self.offset = offset
+            self._save()
+
+    def finish(self):
+        """ The crawl is done; a later resume starts from scratch """
+        if self.store:
+            self.store.clear(self.crawl_id)
@@ -0,0 +1,112 @@
+""" Crawl with several Lending Club accounts in parallel
+
+Each account gets a process of its own, with its own Downloader (and so
+its own session and request budget) and its own MongoManager. The crawl
+is split into one shard per account:
+    download_data - pages of the notes listing, taken in turn
+    download_note_details - pending records, by note_id modulo the number
+                            of shards
+
+All shards write to the same collections. Records and note details are
+upserted on note_id, so a note that two shards both see is stored once.
+"""
+import logging
+from multiprocessing import Process
+
+from checkpoint import FileCheckpointStore, MongoCheckpointStore
+from downloader import Downloader
+from mongo_manager import MongoManager
+
+SHARDED_ACTIONS = ('download_data', 'download_note_details')
+
+
+def run_shard(action, account, shard_index, shard_count, downloader_options,
+              mongo_options, checkpoint_file, crawl_options):
+    """ Run one shard of the crawl; the target of each shard's process """
+    username, password = account
+    logging.info('Shard %d of %d: %s as %s', shard_index + 1, shard_count,
+                 action, username)
+
+    # Before the MongoClient's threads start, for the Downloader's parse pool
+    downloader = Downloader(username=username, password=password,
+                            **downloader_options)
+    try:
+        # Connections can't be shared across a fork, so each shard opens its own
+        mongo_manager = MongoManager(ensure_indexes=False, **mongo_options)
+        if checkpoint_file:
+            # Shards would overwrite each other's updates to a shared file
+            store = FileCheckpointStore('%s.shard-%d' % (checkpoint_file, shard_index))
+        else:
+            store = MongoCheckpointStore(mongo_manager.db)
+
+        getattr(downloader, action)(mongo_manager=mongo_manager,
+                                    checkpoint_store=store,
+                                    shard_index=shard_index,
+                                    shard_count=shard_count,
+                                    **crawl_options)
+    except Exception:
+        logging.exception('Shard %d of %d failed', shard_index + 1, shard_count)
+        raise
+    finally:
+        downloader.close()
+
+
+class ShardedCrawl(object):
+    """ Runs a Downloader crawl split across several accounts.
+
+    Args:
+        accounts (list): (username, password) for each shard
+        downloader_options (dict): keyword arguments for each Downloader
+        mongo_options (dict): keyword arguments for each MongoManager
+        checkpoint_file (str): keep checkpoints in files named after this
+            one (one per shard) instead of in mongo
+    """
+
+    def __init__(self, accounts, downloader_options=None, mongo_options=None,
+                 checkpoint_file=None):
+        if not accounts:
+            raise ValueError('a sharded crawl needs at least one account')
+        self.accounts = accounts
+        self.downloader_options = downloader_options or {}
+        self.mongo_options = mongo_options or {}
+        self.checkpoint_file = checkpoint_file
+
+    def run(self, action, **crawl_options):
+        """ Run Downloader.<action>(**crawl_options) on every shard at once
+        and wait for all of them.
+
+        Returns: True if every shard finished cleanly
+        """
+        if action not in SHARDED_ACTIONS:
+            raise ValueError('%s cannot be sharded' % action)
+
+        # One-off preparation, before the shards race each other to do it
+        mongo_manager = MongoManager(**self.mongo_options)
+        if action == 'download_note_details':
+            mongo_manager.backfill_downloaded_flags()
+        mongo_manager.client.close()
+
+        shard_count = len(self.accounts)
+        processes = []
+        for shard_index, account in enumerate(self.accounts):
+            process = Process(
+                target=run_shard, name='shard-%d' % shard_index,
+                args=(action, account, shard_index, shard_count,
+                      self.downloader_options, self.mongo_options,
+                      self.checkpoint_file, crawl_options))
+            process.start()
+            processes.append(process)
+
+        logging.info('Started %s on %d shards', action, shard_count)
+
+        for process in processes:
+            process.join()
+
+        failed = [process.name for process in processes if process.exitcode != 0]
+        if failed:
+            logging.error('%d of %d shards failed: %s', len(failed), shard_count,
+                          ', '.join(failed))
+        else:
+            logging.info('All %d shards of %s finished', shard_count, action)
+
+        return not failed
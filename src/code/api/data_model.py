@@ -3,6 +3,12 @@ import csv
 import logging
 
 from datetime import datetime
+from itertools import izip
+
+from memoize import intern_string, lru_memoize
+
+
+LOAN_CHUNK_SIZE = 5000  # loans parsed (and written) at a time
 
 
 def consolidate_price_history(history):
@@ -52,26 +58,42 @@ def parse_percentge(percentage):
     return float(percentage.strip()[:-1])
 
 
-def parse_loan_status(loan_status):
+# Some entries are prefixed with a warning like this:
+CREDIT_POLICY_RE = re.compile(
+    'does not meet the (current )?credit policy.( )+status:', re.I)
+
+LOAN_STATUS_CACHE_SIZE = 256
 
-    # Some entries are prefixed with a warning like this:
-    credit_policy_re = re.compile(
-        'does not meet the (current )?credit policy.( )+status:', re.I)
+
+@lru_memoize(maxsize=LOAN_STATUS_CACHE_SIZE)
+def parse_loan_status(loan_status):
+    """ Normalized loan status, memoized on the raw string (so an
+    unknown status is only logged the first time it is seen) """
 
     if loan_status and loan_status != '':
-        if credit_policy_re.search(loan_status):
-            # We dont really care about the credit policy, so we strip it
-            loan_status = credit_policy_re.sub('', loan_status)
+        # We dont really care about the credit policy, so we strip it
+        loan_status = CREDIT_POLICY_RE.sub('', loan_status)
 
         loan_status = loan_status.lower()
         if loan_status in KNOWN_STATUSES:
-            return loan_status
+            return intern_string(loan_status)
         else:
             logging.warning("unknown loan_status: %s", loan_status)
             return "unknown status"
     return None
 
 
+def loan_stats_type_converters():
+    """ (fields, converter) for the typed fields, in the order applied """
+    return [
+        (LOAN_STATS_INT_FIELDS, int),
+        (LOAN_STATS_FLOAT_FIELDS, float),
+        (LOAN_STATS_PERCENT_FIELDS, parse_percentge),
+        (LOAN_STATS_STR_FIELDS, str),
+        (LOAN_STATS_DATE_FIELDS, parse_timestamp_from_date),
+    ]
+
+
 def parse_loan_data_dict(loan_data):
     try:
         loan_data['loanGUID'] = int(loan_data['id'])
@@ -80,15 +102,7 @@ def parse_loan_data_dict(loan_data):
         return
 
     # Convert string fields into better types
-    type_converters = [
-        (LOAN_STATS_INT_FIELDS, int),
-        (LOAN_STATS_FLOAT_FIELDS, float),
-        (LOAN_STATS_PERCENT_FIELDS, parse_percentge),
-        (LOAN_STATS_STR_FIELDS, str),
-        (LOAN_STATS_DATE_FIELDS, parse_timestamp_from_date),
-    ]
-
-    for type_fields, converter_fn in type_converters:
+    for type_fields, converter_fn in loan_stats_type_converters():
 
         for field in type_fields:
             if (loan_data.get(field) and
@@ -112,36 +126,160 @@ def parse_loan_data_dict(loan_data):
     return loan_data
 
 
-def parse_loan_data_from_file(csv_file):
-
-    id_to_loan_data = {}
-
-    logging.info("Parsing %s", csv_file)
-    with open(csv_file, 'r') as csv_data:
-
-        # skip the useless line about the prospectus
-        csv_data.readline()
-
-        reader = csv.DictReader(csv_data)
-
-        for row in reader:
+def convert_column(field, values, converter_fn, cache=None):
+    """ converter_fn applied to a whole column, with the same rules as
+    parse_loan_data_dict: empty and 'null' values become None, and so do
+    values that fail to convert.
+
+    Successful conversions are memoized in `cache` if given, which pays
+    off for columns with few distinct values (dates).
+    """
+    converted = []
+    append = converted.append
+    for value in values:
+        if not value or value == 'null':
+            append(None)
+        elif cache is not None and value in cache:
+            append(cache[value])
+        else:
             try:
-                loan_id = int(row['id'])
+                result = converter_fn(value)
             except ValueError:
-                logging.info(
-                    "skipping row with non-numeric id: %s", row['id'])
+                logging.warning("Error converting field %s (%s)", field, value)
+                result = None
             else:
-                id_to_loan_data[loan_id] = parse_loan_data_dict(row)
+                if cache is not None:
+                    cache[value] = result
+            append(result)
+    return converted
+
+
+def parse_loan_data_columns(header, rows, date_cache=None):
+    """ Same as running parse_loan_data_dict on a csv.DictReader dict of
+    each row, but converting a column at a time.
+
+    Args:
+        header (list): field names
+        rows (list): rows (lists of strings) with a numeric id
+        date_cache (dict): memoized dates, to share between calls
+
+    Returns: list of loan data dicts, in the order of rows
+    """
+    row_count = len(rows)
+
+    # As in DictReader: short rows are padded with None, the last of
+    # repeated field names wins
+    field_index = dict((field, i) for i, field in enumerate(header))
+    columns = {}
+    for field, i in field_index.iteritems():
+        columns[field] = [row[i] if i < len(row) else None for row in rows]
+
+    missing = [None] * row_count
+    if date_cache is None:
+        date_cache = {}
+    for type_fields, converter_fn in loan_stats_type_converters():
+        cache = date_cache if converter_fn is parse_timestamp_from_date else None
+        for field in type_fields:
+            columns[field] = convert_column(
+                field, columns.get(field, missing), converter_fn, cache)
+
+    columns['loanGUID'] = columns['id']
+    columns['pymnt_plan'] = [parse_payment_plan(value) for value in
+                             columns.get('pymnt_plan', missing)]
+    columns['is_inc_v'] = [parse_verified_income(value) for value in
+                           columns.get('is_inc_v', missing)]
+    columns['loan_status'] = [parse_loan_status(value) for value in
+                              columns.get('loan_status', missing)]
+    columns['term'] = [parse_term(value) for value in
+                       columns.get('term', missing)]
+
+    fields = columns.keys()
+    loans = [dict(izip(fields, values))
+             for values in izip(*[columns[field] for field in fields])]
+
+    # Cells beyond the header go under None, as DictReader does
+    for loan_data, row in izip(loans, rows):
+        if len(row) > len(header):
+            loan_data[None] = row[len(header):]
+
+    return loans
+
+
+def iter_loan_data_chunks(csv_file, chunk_size=LOAN_CHUNK_SIZE):
+    """ Parse the loan stats CSV a chunk at a time, yielding a dict of
+    loan id -> loan data (see parse_loan_data_dict) for every chunk_size
+    rows, so only one chunk is held in memory. Each chunk is converted a
+    column at a time.
+
+    csv_file is a path, or any iterable of lines (e.g. a download being
+    streamed in).
+
+    A loan id repeated in a later chunk shows up again in that chunk.
+    """
+
+    if isinstance(csv_file, basestring):
+        logging.info("Parsing %s in chunks of %s rows", csv_file, chunk_size)
+        with open(csv_file, 'r') as csv_data:
+            for chunk in iter_loan_data_chunks(csv_data, chunk_size):
+                yield chunk
+        return
 
-            if len(id_to_loan_data) % 10000 == 0:
-                logging.info("parsed %s records", len(id_to_loan_data))
+    csv_data = iter(csv_file)
+    # skip the useless line about the prospectus
+    next(csv_data)
+
+    reader = csv.reader(csv_data)
+    header = next(reader)
+    id_index = dict((field, i) for i, field in enumerate(header)).get(
+        'id', len(header))
+
+    date_cache = {}
+    loan_count = 0
+    loan_ids = []
+    rows = []
+    for row in reader:
+        if not row:
+            continue  # DictReader skips blank lines
+
+        loan_id = row[id_index] if id_index < len(row) else None
+        try:
+            loan_ids.append(int(loan_id))
+        except ValueError:
+            logging.info(
+                "skipping row with non-numeric id: %s", loan_id)
+            continue
+
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            loan_count += len(rows)
+            yield dict(izip(loan_ids, parse_loan_data_columns(
+                header, rows, date_cache)))
+            logging.info("parsed %s records", loan_count)
+            loan_ids = []
+            rows = []
+
+    if rows:
+        loan_count += len(rows)
+        yield dict(izip(loan_ids, parse_loan_data_columns(
+            header, rows, date_cache)))
+
+    logging.info("parsed %s rows of historical loan data", loan_count)
+    parse_loan_status.cache.log_stats('loan_status')
 
-        logging.info("fetched historical data for %s loans",
-                     len(id_to_loan_data))
+
+def parse_loan_data_from_file(csv_file):
+    """ Parse the whole loan stats CSV into a dict of
+    loan id -> loan data (see parse_loan_data_dict) """
+
+    id_to_loan_data = {}
+    for chunk in iter_loan_data_chunks(csv_file):
+        id_to_loan_data.update(chunk)
+
+    logging.info("fetched historical data for %s loans", len(id_to_loan_data))
 
     return id_to_loan_data
 
-KNOWN_STATUSES = [
+KNOWN_STATUSES = frozenset([
     'issued',
     'current',
     'in grace period',
@@ -150,7 +288,7 @@ KNOWN_STATUSES = [
     'fully paid',
     'default',
     'charged off',
-]
+])
 
 LOAN_STATS_INT_FIELDS = [
     "id",
@@ -1,22 +1,36 @@
 import json
+import os
 import random
 import time
 import logging
 import codecs
 import socket
-from sets import Set
+import threading
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
+from StringIO import StringIO
 
 from cookielib import CookieJar
 from getpass import getpass
+from urllib import addinfourl
 from urllib import urlencode
-from urllib import urlretrieve
 from urllib2 import build_opener
 from urllib2 import HTTPCookieProcessor
-from urllib2 import HTTPSHandler
-
-from data_model import parse_loan_data_from_file
-from lc_parser import LoanHTMLParser, NoteHTMLParser
+from urllib2 import HTTPError
+from urllib2 import Request
+
+from checkpoint import CrawlCheckpoint
+from data_model import LOAN_CHUNK_SIZE
+from data_model import iter_loan_data_chunks
+from keepalive import DEFAULT_POOL_SIZE, KeepAliveHTTPSHandler
+from lc_parser import parse_loan_page, parse_note_page
+from pipeline import BackgroundConsumer, prefetch
+from rate_limiter import CircuitOpenError, DEFAULT_MAX_RPS, RateLimiter
+from session import SessionHealth
+from stream_download import iter_blocks, iter_decoded, iter_lines, tee
+from stream_download import load_validators, save_validators
 
 ACCOUNT_SUMMARY_URL = 'https://www.lendingclub.com/account/summary.action'
 NOTES_URL = 'https://www.lendingclub.com/foliofn/browseNotesAj.action'
@@ -27,25 +41,48 @@ LOGGED_IN_VALIDATION = 'Welcome'
 
 LOAN_DATA_CSV_URL = 'https://www.lendingclub.com/' + \
     'fileDownload.action?file=LoanStatsNew.csv&type=gen'
-LOAN_DATA_CSV_TMPFILE = '/tmp/loan_stats_new.csv'
+LOAN_DATA_VALIDATORS_FILENAME = 'loan_stats_validators.json'
+LOAN_DATA_CACHE_FILENAME = 'loan_stats.csv'
 IN_FUNDING_DATA_CSV = 'https://www.lendingclub.com/' + \
     'fileDownload.action?file=InFunding2StatsNew.csv&type=gen'
 
 NOTE_INFO_BASE_URL = 'https://www.lendingclub.com/foliofn/browseNotesLoanPerf.action'
 LOAN_INFO_BASE_URL = 'https://www.lendingclub.com/foliofn/loanDetail.action'
 
+# Pages worth keeping in the response archive (no account/login pages)
+ARCHIVED_URLS = (NOTES_URL, NOTE_INFO_BASE_URL, LOAN_INFO_BASE_URL)
+
 # Yes I am Chrome.
 DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64) ' + \
     'AppleWebKit/537.36 (KHTML, like Gecko) ' + \
     'Chrome/28.0.1500.72 Safari/537.36'
 
-# random sleep between requests (in seconds)
-MIN_SLEEP = 0
-MAX_SLEEP = 1
-
 TIMEOUT = 10
-TIMEOUT_SLEEP = 60
-TIMEOUT_RETRY = 60      # retry for one hour?
+TIMEOUT_RETRY = 60      # upper bound; the circuit breaker usually gives up first
+VERIFY_READ_RETRIES = 3
+
+# number of concurrent detail fetches; 1 keeps the old sequential crawl
+DEFAULT_WORKERS = 1
+
+# pages of notes fetched ahead of processing, and pages queued for mongo
+DEFAULT_PREFETCH_PAGES = 4
+WRITE_QUEUE_DEPTH = 4
+
+# pages handed to the parser processes per worker before fetchers block
+PARSE_QUEUE_DEPTH_PER_WORKER = 2
+PARSE_TIMEOUT = 60 * 60  # seconds; lets a stuck wait still see Ctrl-C
+
+class PageFetchError(Exception):
+    """ A page of the notes listing could not be fetched """
+    pass
+
+
+def shard_crawl_id(crawl_id, shard_index, shard_count):
+    """ Each shard of a sharded crawl keeps its own checkpoint """
+    if shard_count > 1:
+        return '%s-shard-%d-of-%d' % (crawl_id, shard_index, shard_count)
+    return crawl_id
+
 
 def build_note_info_url(note_id, loan_id, order_id):
     return NOTE_INFO_BASE_URL + \
@@ -56,8 +93,10 @@ class Downloader(object):
 
     def __init__(self, username=None, password=None,
                  debug=False, naptime=True,
-                 user_agent=DEFAULT_USER_AGENT):
-        self.sleep_after_request = naptime
+                 user_agent=DEFAULT_USER_AGENT, max_rps=None,
+                 rate_limiter=None, parse_workers=0, parse_queue_depth=None,
+                 archive=None, replay=False, replay_as_of=None,
+                 pool_size=DEFAULT_POOL_SIZE):
         self.user_agent = user_agent
         self.debug = debug
 
@@ -66,33 +105,98 @@ class Downloader(object):
         self.password = password
         self.logged_in = False
 
+        # Raw responses are saved to `archive`; with replay=True they are
+        # served from it instead, without touching the network
+        if replay and not archive:
+            raise ValueError('replay needs an archive to replay from')
+        self.archive = archive
+        self.replay = replay
+        self.replay_as_of = replay_as_of
+
+        # Global request budget, shared by every worker using this session.
+        # naptime=False turns throttling off entirely.
+        if rate_limiter is None:
+            if naptime and not max_rps:
+                max_rps = DEFAULT_MAX_RPS
+            rate_limiter = RateLimiter(max_rps=max_rps if naptime else None)
+        self.rate_limiter = rate_limiter
+
+        # HTML parsing runs in worker processes so it doesn't hold the GIL
+        # against the fetching threads. Forking with threads running can
+        # deadlock the workers, so create the Downloader before anything
+        # that starts threads (a MongoClient starts its own).
+        self.parse_pool = None
+        if parse_workers > 0:
+            self.parse_pool = Pool(parse_workers)
+            self.parse_slots = threading.BoundedSemaphore(
+                parse_queue_depth or
+                parse_workers * PARSE_QUEUE_DEPTH_PER_WORKER)
+
+        # Pooled keep-alive connections; debuglevel=1 makes it noisy
+        self.https_handler = KeepAliveHTTPSHandler(
+            pool_size=pool_size, debuglevel=1 if self.debug else 0)
+
         self.cookie_jar = CookieJar()
-        if self.debug:
-            # Noisy HTTPS handler for debugging
-            self.url_opener = build_opener(
-                HTTPCookieProcessor(self.cookie_jar),
-                HTTPSHandler(debuglevel=1))
-        else:
-            self.url_opener = build_opener(
-                HTTPCookieProcessor(self.cookie_jar))
+        self.session = SessionHealth(self.cookie_jar)
+        self.url_opener = build_opener(
+            HTTPCookieProcessor(self.cookie_jar),
+            self.https_handler)
 
         self.url_opener.addheaders = [
             ('User-Agent', self.user_agent)
         ]
 
+        # Big files are streamed, which the keep-alive handler can't do
+        # (it reads whole bodies), so they go through the stock handler
+        self.download_opener = build_opener(
+            HTTPCookieProcessor(self.cookie_jar))
+        self.download_opener.addheaders = [
+            ('User-Agent', self.user_agent)
+        ]
+
         logging.info('Downloader intialized.')
 
     def open_url(self, url, data=None, method='GET', verify=False):
         """
         Consistent place to introduce request throttling
         and other HTTP magic
+
+        Requests go through self.rate_limiter: a token bucket paces them,
+        failures are retried with exponential backoff, and once the circuit
+        breaker opens we give up immediately instead of retrying.
+
+        With verify=True, a session that is about to expire is renewed
+        first, and a response that was redirected to the login page makes
+        us log in again (once) and repeat the request.
         """
 
         if method != 'GET' and method != 'POST':
             raise ValueError("%s is not a valid HTTP method" % method)
 
+        archived = self.archive and method == 'GET' and url in ARCHIVED_URLS
+
+        if self.replay:
+            body = None
+            if archived:
+                body = self.archive.lookup(url, data, self.replay_as_of)
+            if body is None:
+                logging.warning('Nothing archived for url %s with data %s', url, data)
+                return {}
+            return addinfourl(StringIO(body), {}, url)
+
+        if verify:
+            generation = self.session_generation()
+        relogged = False
+
         attempt = 1
         while attempt <= TIMEOUT_RETRY:
+            try:
+                self.rate_limiter.before_request()
+            except CircuitOpenError as e:
+                logging.error('Not fetching url %s with data %s: %s', url, data, e)
+                return {}
+
+            request_start = time.time()
             try:
                 if method == 'GET':
                     dataurl = url
@@ -103,10 +207,20 @@ class Downloader(object):
                 elif method == 'POST':
                     response = self.url_opener.open(url, data=urlencode(data), timeout=TIMEOUT)
 
-                if self.sleep_after_request:
-                    sleep_time = random.randint(MIN_SLEEP, MAX_SLEEP)
-                    #logging.debug('Taking a nap for %s seconds', sleep_time)
-                    time.sleep(sleep_time)
+                if archived:
+                    body = response.read()
+                    self.archive.store(url, data, body)
+                    response = addinfourl(StringIO(body), response.info(),
+                                          response.geturl(), response.getcode())
+
+                self.rate_limiter.record_success(time.time() - request_start)
+
+                if verify and not relogged and \
+                        self.session.is_logged_out_response(response):
+                    logging.warning('Fetching url %s got the login page', url)
+                    relogged = True
+                    self.relogin(generation)
+                    continue
 
                 return response
 
@@ -122,20 +236,82 @@ class Downloader(object):
                 logging.warning("Failed to fetch url %s with data %s, [%d/%d]",
                                 url, data, attempt, TIMEOUT_RETRY)
               
-            attempt = attempt + 1
+            if self.rate_limiter.record_failure(time.time() - request_start):
+                logging.error('Circuit breaker opened while fetching url %s', url)
+                break
 
-            if (attempt <= TIMEOUT_RETRY):
-                time.sleep(TIMEOUT_SLEEP)
+            if (attempt < TIMEOUT_RETRY):
+                self.rate_limiter.wait_before_retry(attempt)
+
+            attempt = attempt + 1
 
-            if verify and not self.verify_login():
-                self.login()
-        
         # end attemp
         
-        logging.critical('Error fetching url %s with data %s after %d tries.', url, str(data), TIMEOUT_RETRY)
+        logging.critical('Error fetching url %s with data %s after %d tries.', url, str(data),
+                         min(attempt, TIMEOUT_RETRY))
 
         return {}
 
+    def check_circuit(self, context):
+        """ Raise CircuitOpenError if the circuit breaker is open.
+
+        open_url fails fast while it is open, so whatever was just fetched
+        is incomplete: a crawl must stop rather than record it as done,
+        keeping its checkpoint for a later resume.
+        """
+        if self.rate_limiter.breaker.is_open():
+            raise CircuitOpenError('circuit breaker open %s' % context)
+
+    def session_generation(self):
+        """ Generation of the current session, renewing it first if it is
+        about to expire """
+        generation = self.session.generation
+        if self.session.needs_renewal():
+            self.relogin(generation)
+            generation = self.session.generation
+        return generation
+
+    def relogin(self, generation):
+        """ Log in again, unless another worker already did so since
+        `generation` """
+        return self.session.renew(
+            generation, lambda: self.login(invalidate_session=True))
+
+    def close(self):
+        self.https_handler.close_all()
+        if self.parse_pool:
+            self.parse_pool.close()
+            self.parse_pool.join()
+            self.parse_pool = None
+
+    def parse_page(self, parse_fn, page):
+        """ parse_fn(page), run in the parser pool if there is one.
+        At most parse_queue_depth pages are in flight; callers beyond that
+        block until a slot frees up.
+        """
+        if not self.parse_pool:
+            return parse_fn(page)
+
+        with self.parse_slots:
+            return self.parse_pool.apply_async(
+                parse_fn, (page,)).get(PARSE_TIMEOUT)
+
+    def log_request_stats(self):
+        stats = self.rate_limiter.stats()
+        logging.info('%d requests (%d failed): %.1fs on the wire, '
+                     '%.1fs throttled, %.1fs backing off',
+                     stats['requests'], stats['failures'], stats['wire_time'],
+                     stats['throttled_time'], stats['backoff_time'])
+
+        stats = self.https_handler.stats()
+        logging.info('%d connections opened, %d reused (%d were stale); '
+                     '%d bytes received, %d after decompression',
+                     stats['new_connections'], stats['reused_connections'],
+                     stats['stale_retries'], stats['bytes_received'],
+                     stats['bytes_decoded'])
+
+        logging.info('session renewed %d times', self.session.renewals)
+
     def verify_login(self, resp=None):
         """
         Tries to fetch the Account Summary page,
@@ -148,21 +324,30 @@ class Downloader(object):
         Returns: True if the we're actually logged in;
                  also updates self.logged_in
         """
-        response_got = False
+        resp_text = None
 
-        while not response_got:
+        for attempt in range(1, VERIFY_READ_RETRIES + 1):
 
             if not resp:
                 resp = self.open_url(ACCOUNT_SUMMARY_URL)
+                if not resp:
+                    # open_url gave up (circuit breaker open, or out of
+                    # retries): retrying here would only spin
+                    logging.warning("verify_login: no response to verify")
+                    break
 
             try:
                 resp_text = resp.read()
-                response_got = True
+                break
 
-            except:
-                logging.warning("verify_login: cannot read verify response")
-                
-        # end response_got
+            except Exception:
+                logging.warning("verify_login: cannot read verify response [%d/%d]",
+                                attempt, VERIFY_READ_RETRIES)
+                resp = None
+
+        if resp_text is None:
+            self.logged_in = False
+            return self.logged_in
 
         # Look for a known tag that appears only for logged in users
         if resp_text.find(LOGGED_IN_VALIDATION) >= 0:
@@ -178,6 +363,7 @@ class Downloader(object):
         except KeyError:
             pass
 
+        self.session.mark_logged_out()
         logging.debug('Cleared cookies')
 
     def login(self, invalidate_session=False, retries=5):
@@ -187,7 +373,8 @@ class Downloader(object):
             1. Get a set of session cookies by visiting ACCOUNT_SUMMARY_URL
             2. Authenticate the session cookies with a username / password
 
-        If self.logged_in is already set, this will verify that we're logged in
+        If self.logged_in is already set and the session isn't due for
+        renewal, the existing session is kept
 
         Args:
             invalidate_session (bool): will clear cookies and
@@ -198,9 +385,15 @@ class Downloader(object):
 
         """
 
-        if self.logged_in and not invalidate_session and self.verify_login():
-            # Ensure we're logged in and aren't trying to reset our session
-            logging.debug('Ensuring that we already have an active session')
+        if self.replay:
+            # Archived pages were fetched logged in; there is no session
+            self.logged_in = True
+            return self.logged_in
+
+        if self.logged_in and not invalidate_session and \
+                not self.session.needs_renewal():
+            # Logged out sessions are spotted in open_url, no need to check
+            logging.debug('Reusing the active session')
             return self.logged_in
 
         if not self.logged_in or invalidate_session:
@@ -233,6 +426,7 @@ class Downloader(object):
             # Validate the login attempt
             if self.verify_login(response):
                 self.logged_in = True
+                self.session.mark_logged_in()
 
                 # We dont need the LC_FIRSTNAME cookie that was just set
                 self.cookie_jar.clear('.lendingclub.com', '/', 'LC_FIRSTNAME')
@@ -244,6 +438,7 @@ class Downloader(object):
                 self.username = None
                 self.password = None
                 self.logged_in = False
+                self.session.mark_logged_out()
                 if attempt < retries:
                     logging.warning(
                         'Login attempt %s of %s failed. Will try again.',
@@ -312,21 +507,30 @@ class Downloader(object):
 
         QUERY_STATUS_KEY = 'result'
 
-        response = self.open_url(NOTES_URL, request_params, verify = True)
-        try:
-            response_data = response.readline()
-            json_data = json.loads(response_data)
-            query_status = json_data.get(QUERY_STATUS_KEY)
-            if query_status == 'success':
-                return json_data
-        except Exception as e:
-            log_line = 'Error parsing response: %s\n RESP: %s' % (
-                e, response_data)
-            logging.warning(log_line)
-        else:
-            log_line = 'Failed to fetch data. \n RESP: %s' % (
-                json_data)
-            logging.warning(log_line)
+        for attempt in (1, 2):
+            generation = self.session.generation
+            response = self.open_url(NOTES_URL, request_params, verify = True)
+            response_data = ''
+            try:
+                response_data = response.readline()
+                json_data = json.loads(response_data)
+                query_status = json_data.get(QUERY_STATUS_KEY)
+                if query_status == 'success':
+                    return json_data
+            except Exception as e:
+                log_line = 'Error parsing response: %s\n RESP: %s' % (
+                    e, response_data)
+                logging.warning(log_line)
+                break
+            else:
+                log_line = 'Failed to fetch data. \n RESP: %s' % (
+                    json_data)
+                logging.warning(log_line)
+
+            # A reply without any result means we were logged out
+            if query_status is not None or attempt > 1:
+                break
+            self.relogin(generation)
 
 
         # Escalate logging to ERROR if we fail fetching after many retries
@@ -348,8 +552,7 @@ class Downloader(object):
 
         try:
             response_page = response.read()
-            note_parser = NoteHTMLParser(response_page)
-            note_info = note_parser.get_info()
+            note_info = self.parse_page(parse_note_page, response_page)
             query_status = note_info.get(QUERY_STATUS_KEY)
             if query_status == True:
                 return note_info
@@ -374,8 +577,7 @@ class Downloader(object):
 
         try:
             response_page = response.read()
-            loan_parser = LoanHTMLParser(response_page)
-            loan_info = loan_parser.get_info()
+            loan_info = self.parse_page(parse_loan_page, response_page)
             query_status = loan_info.get(QUERY_STATUS_KEY)
             if query_status == True:
                 return loan_info
@@ -396,60 +598,171 @@ class Downloader(object):
         formated.update(note_detail)
         return formated
 
-    def download_note_details(self, mongo_manager, pagesize=250):
-        """ download note details from lc using records stored in mongo_manager 
+    def fetch_record_detail(self, note_id, record_ids):
+        """ Fetch and merge the note and loan pages of a single record.
+
+        Returns: (note_id, record_detail), record_detail is None on failure
         """
-        
-        logging.info('Fetching records from mongo_manager')
+        logging.debug('Fetching note %s, loan_id %s, order_id %s',
+                      record_ids['noteId'], record_ids['loanGUID'], record_ids['orderId'])
 
-        all_record_ids = mongo_manager.get_records()
+        note_detail = self.get_note_details(record_ids)
+        loan_detail = self.get_loan_details(record_ids)
+        if not note_detail or not loan_detail:
+            logging.warning('Failed to fetch note %s, omitting that', record_ids['noteId'])
+            return note_id, None
 
-        total_record_count = len(all_record_ids)
+        return note_id, self.format_record_detail(note_id, note_detail, loan_detail)
 
-        logging.info('Fetched %s record', total_record_count)
+    def _fetch_record_detail_star(self, args):
+        return self.fetch_record_detail(*args)
+
+    def fetch_record_details(self, page_record_ids, pool=None):
+        """ Fetch the details of a page of records, optionally in parallel.
+
+        Args:
+            page_record_ids (list): (note_id, record_ids) pairs
+            pool (ThreadPool): workers to fetch with; None fetches serially
+
+        Returns: dict of note_id -> record detail, omitting failed records
+        """
+        if pool:
+            page_results = pool.map(self._fetch_record_detail_star,
+                                    page_record_ids, chunksize=1)
+        else:
+            page_results = [self.fetch_record_detail(note_id, record_ids)
+                            for note_id, record_ids in page_record_ids]
+
+        return dict((note_id, record_detail)
+                    for note_id, record_detail in page_results if record_detail)
+
+    def download_note_details(self, mongo_manager, pagesize=250,
+                              workers=DEFAULT_WORKERS, checkpoint_store=None,
+                              resume=False, crawl_id='download_note_details',
+                              shard_index=0, shard_count=1):
+        """ download note details from lc using records stored in mongo_manager
+
+        Args:
+            mongo_manager (MongoManager): source of pending record ids
+                (streamed, never loaded all at once) and sink for the
+                fetched details
+            pagesize (int): number of records written to mongo at once
+            workers (int): number of records fetched concurrently. All
+                workers share this session's cookies and request budget
+                (see max_rps).
+            checkpoint_store: where to record progress (see checkpoint.py)
+            resume (bool): skip past the note_id this crawl had written up
+                to when it was interrupted
+            shard_index, shard_count: only fetch the pending records whose
+                note_id is shard_index modulo shard_count (see coordinator.py)
+
+        Raises: CircuitOpenError if the circuit breaker opens; the page in
+            progress is not recorded and the checkpoint is kept
+        """
+
+        if shard_count == 1:
+            # A sharded crawl's coordinator does this once, for all shards
+            mongo_manager.backfill_downloaded_flags()
+        checkpoint = CrawlCheckpoint(
+            checkpoint_store, shard_crawl_id(crawl_id, shard_index, shard_count),
+            resume, offset=None)
+
+        total_record_count = mongo_manager.count_pending_records(
+            shard_index, shard_count)
+
+        logging.info('%s records left to download', total_record_count)
 
         self.login()
-        logging.info('Start downloading at %s' % str(datetime.now()))
-        
-        count = 1
-        page_record_details = {}
+        logging.info('Start downloading at %s with %d worker(s)',
+                     str(datetime.now()), workers)
+
+        pool = ThreadPool(workers) if workers > 1 else None
+
+        count = 0
         start_time = time.time()
+        record_iter = mongo_manager.iter_pending_records(
+            start_after=checkpoint.offset, shard_index=shard_index,
+            shard_count=shard_count)
 
-        for note_id, record_ids in all_record_ids.iteritems():
+        def write_page(item):
+            page_record_details, last_note_id, note_ids = item
+            mongo_manager.add_note_details(page_record_details)
+            checkpoint.complete(last_note_id, note_ids)
 
-            logging.debug('Fetching note %s, loan_id %s, order_id %s', 
-                          record_ids['noteId'], record_ids['loanGUID'], record_ids['orderId'])
+        try:
+            with BackgroundConsumer(write_page,
+                                    depth=WRITE_QUEUE_DEPTH) as writer:
+                while True:
+                    page_record_ids = list(islice(record_iter, pagesize))
+                    if not page_record_ids:
+                        break
+
+                    note_ids = [note_id for note_id, record_ids in page_record_ids]
+                    checkpoint.start(note_ids)
+                    page_record_details = self.fetch_record_details(
+                        page_record_ids, pool)
+                    self.check_circuit('fetching notes %s to %s' %
+                                       (note_ids[0], note_ids[-1]))
+                    writer.put((page_record_details, note_ids[-1], note_ids))
+
+                    count += len(page_record_ids)
+                    logging.info('Fetched %s records, %.2f mins elapsed..', count, (time.time() - start_time)/60)
+                # end loop of pages
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        checkpoint.finish()
+
+        logging.info('Fetched %s records; download complete at %s. %.2f min elapsed.',
+                     count, str(datetime.now()), (time.time() - start_time)/60)
+        self.log_request_stats()
+
+    def iter_pages_of_notes(self, record_limit, pagesize, offset=0,
+                            shard_index=0, shard_count=1):
+        """ Yield (offset, list of records) for each page of the current
+        query, up to record_limit.
+
+        With shard_count > 1, only every shard_count-th page is fetched,
+        starting with page number shard_index.
+
+        Raises: PageFetchError at the first failed page, so callers can
+            tell a crawl cut short from one that got to the end
+        """
+        RESULT_SET_KEY = 'searchresult'
+        LOANS_KEY = 'loans'
 
-            note_detail = self.get_note_details(record_ids)
-            loan_detail = self.get_loan_details(record_ids)
-            if not note_detail or not loan_detail:
-                logging.warning('Failed to fetch note %s, omitting that', record_ids['noteId'])
+        while offset < record_limit:
+
+            if (offset // pagesize) % shard_count != shard_index:
+                offset += pagesize
                 continue
 
-            record_detail = self.format_record_detail(note_id, note_detail, loan_detail)
-            page_record_details[note_id] = record_detail
-        
-            if (count % pagesize == 0):
-                mongo_manager.add_note_details(page_record_details)
-                logging.info('Fetched %s records, %.2f mins elapsed..', count, (time.time() - start_time)/60)
-                page_record_details = {}
-                time.sleep(1)
+            # Set the query arguments and fetch the data in a nice dict
+            query_args = {'offset': offset, 'limit': pagesize, }
 
-            count = count+1
-        # end loop of record
+            fetched_data = self.get_page_of_notes(**query_args)
 
-        logging.info('Fetched %s records; download complete at %s. %.2f min elapsed.', 
-                     count, str(datetime.now()), (time.time() - start_time)/60)
+            # Break out early if we're not getting sensible results
+            if not fetched_data:
+                self.check_circuit('fetching the page at offset %s' % offset)
+                raise PageFetchError('failed to fetch the page at offset %s'
+                                     % offset)
 
-    def download_data(self, max_records=250, pagesize=250, mongo_manager=None, download_details=True):
-        """ Paginate through enough pages of results to get the desired
-        number of records. Optionally ignore negative YTM to reduce
-        the result set.
+            # Get a list of records from the result
+            yield offset, fetched_data.get(RESULT_SET_KEY, {}).get(LOANS_KEY, [])
+
+            offset += pagesize
+
+    def start_query(self, max_records):
+        """ Log in, set up the search query and work out how many of its
+        matching records we plan to fetch.
+
+        Returns: the record limit for this crawl
         """
 
         RECORD_COUNT_KEY = 'totalRecords'
-        RESULT_SET_KEY = 'searchresult'
-        LOANS_KEY = 'loans'
 
         # ensure we're logged in
         self.login()
@@ -462,81 +775,273 @@ class Downloader(object):
 
         total_record_count = int(
             self.get_page_of_notes(limit=1).get(RECORD_COUNT_KEY, 0))
+        self.check_circuit('fetching the record count')
 
         # How many results do we plan to fetch?
         record_limit = min(max_records, total_record_count)
         logging.info('Fetching up to %s of %s matching records',
                      record_limit, total_record_count)
 
-        all_records = {}
-        records_set = Set()
+        return record_limit
 
-        offset = 0
+    def iter_record_pages(self, record_limit, pagesize,
+                          prefetch_pages=DEFAULT_PREFETCH_PAGES, offset=0,
+                          shard_index=0, shard_count=1):
+        """ Yield (offset, page) for each page of the current query, where
+        page is a dict of note_id -> record, as soon as it arrives. Pages
+        are prefetched in a background thread.
+
+        Only a count of the records is kept, so memory doesn't grow with
+        the size of the market. Duplicates are looked for within a page and
+        against the previous page, where a market that moved between
+        requests puts them.
+        """
+        record_count = 0
+        previous_note_ids = set()
 
         logging.info('Start downloading at %s' % str(datetime.now()))
         start_time = time.time()
 
-        while offset < record_limit:
-            
-            logging.debug('Fetched %s; getting %s more records from the site',
-                          len(records_set), pagesize)
+        pages = prefetch(self.iter_pages_of_notes(record_limit, pagesize, offset,
+                                                  shard_index, shard_count),
+                         depth=prefetch_pages)
+        try:
+            for offset, fetched_records in pages:
 
-            # Set the query arguments and fetch the data in a nice dict
-            query_args = {'offset': offset, 'limit': pagesize, }
+                logging.debug('Fetched %s; processing page at offset %s',
+                              record_count, offset)
 
-            fetched_data = self.get_page_of_notes(**query_args)
+                page_records = {}
 
-            # Break out early if we're not getting sensible results
-            if not fetched_data:
-                break
+                for record in fetched_records:
 
-            # Get a list of records from the result
-            fetched_records = fetched_data.get(
-                RESULT_SET_KEY, {}).get(LOANS_KEY, [])
-            
-            page_record_details = {}
-            page_record_ids = {}
-
-            for record in fetched_records:
-
-                note_id = record.get('noteId')
-                if note_id in records_set:
-                    logging.warning('Looks like we got a duplicate record: %s', record)
-
-                if mongo_manager :
-                    if (download_details):
-                        note_detail = self.get_note_details(record)
-                        loan_detail = self.get_loan_details(record)
-                        record_detail = self.format_record_detail(note_id, note_detail, loan_detail)
-                        page_record_details[note_id] = record_detail
-                    else:
-                        record_ids = {}
-                        record_ids['loan_id'] = record.get('loanGUID')
-                        record_ids['order_id'] = record.get('orderId')
-                        record_ids['note_id'] = record.get('noteId')
-                        page_record_ids[note_id] = record_ids
-                else:
-                    all_records[note_id] = record
+                    note_id = record.get('noteId')
+                    if note_id in page_records or note_id in previous_note_ids:
+                        logging.warning('Looks like we got a duplicate record: %s', record)
 
-                records_set.add(note_id)
-            # end loop of record
+                    page_records[note_id] = record
+                # end loop of record
 
-            if mongo_manager :
-                if (download_details):
-                    mongo_manager.add_note_detail(page_record_details)
-                else:
-                    mongo_manager.add_note_ids(page_record_ids)
+                record_count += len(page_records)
+                previous_note_ids = set(page_records)
 
-            offset += pagesize
-        # end loop of pages
+                yield offset, page_records
+            # end loop of pages
+        finally:
+            pages.close()
 
         logging.info('Fetched %s records; download complete at %s. %.2f min elapsed.', 
-                     len(records_set), str(datetime.now()), (time.time() - start_time)/60)
+                     record_count, str(datetime.now()), (time.time() - start_time)/60)
+        self.log_request_stats()
+
+    def download_data(self, max_records=250, pagesize=250, mongo_manager=None,
+                      download_details=True, workers=DEFAULT_WORKERS,
+                      prefetch_pages=DEFAULT_PREFETCH_PAGES, stream=False,
+                      checkpoint_store=None, resume=False,
+                      crawl_id='download_data', shard_index=0, shard_count=1):
+        """ Paginate through enough pages of results to get the desired
+        number of records. Optionally ignore negative YTM to reduce
+        the result set.
+
+        The crawl is pipelined: a background thread prefetches up to
+        prefetch_pages pages while this thread fetches note details (with
+        `workers` threads), and another background thread writes finished
+        pages to mongo_manager. The stages are joined by bounded queues, so
+        a slow stage holds back the faster ones instead of piling up pages.
+
+        With a checkpoint_store, the offset of the last page written to
+        mongo is recorded as the crawl goes, and resume=True restarts from
+        there. The market moves between runs, so a resumed crawl is only
+        approximately aligned with the pages it skips.
+
+        With shard_count > 1 this crawl only fetches its shard of the
+        pages (see iter_pages_of_notes), so several accounts can split the
+        listing between them (see coordinator.py).
+
+        Returns: dict of note_id -> record when there is no mongo_manager.
+            With stream=True, returns a generator of such dicts, one per
+            page, so the caller never holds the whole market in memory.
+
+        Raises: CircuitOpenError if the circuit breaker opens; the page in
+            progress is not recorded and the checkpoint is kept
+        """
+
+        record_limit = self.start_query(max_records)
+
+        if stream:
+            return self._iter_pages_until_failure(
+                self.iter_record_pages(record_limit, pagesize, prefetch_pages,
+                                       shard_index=shard_index,
+                                       shard_count=shard_count))
+
+        checkpoint = CrawlCheckpoint(
+            checkpoint_store, shard_crawl_id(crawl_id, shard_index, shard_count),
+            resume)
+        pages = self.iter_record_pages(record_limit, pagesize, prefetch_pages,
+                                       offset=checkpoint.offset,
+                                       shard_index=shard_index,
+                                       shard_count=shard_count)
+
+        all_records = {}
+
+        if not mongo_manager:
+            write_records = all_records.update
+        elif download_details:
+            write_records = mongo_manager.add_note_details
+        else:
+            write_records = mongo_manager.add_note_ids
+
+        def write_page(item):
+            page_records, offset, note_ids = item
+            write_records(page_records)
+            # Up to the next page of this shard
+            checkpoint.complete(offset + pagesize * shard_count, note_ids)
+
+        pool = ThreadPool(workers) if workers > 1 and mongo_manager and download_details else None
+
+        complete = False
+        try:
+            with BackgroundConsumer(write_page, depth=WRITE_QUEUE_DEPTH) as writer:
+                try:
+                    for offset, page_records in pages:
+
+                        note_ids = page_records.keys()
+                        checkpoint.start(note_ids)
+
+                        if not mongo_manager:
+                            writer.put((page_records, offset, note_ids))
+                        elif download_details:
+                            page_record_details = self.fetch_record_details(
+                                page_records.items(), pool)
+                            self.check_circuit('fetching the notes of the page '
+                                               'at offset %s' % offset)
+                            writer.put((page_record_details, offset, note_ids))
+                        else:
+                            writer.put((dict(
+                                (note_id, {
+                                    'loan_id': record.get('loanGUID'),
+                                    'order_id': record.get('orderId'),
+                                    'note_id': note_id,
+                                }) for note_id, record in page_records.iteritems()),
+                                offset, note_ids))
+                    # end loop of pages
+                    complete = True
+                except PageFetchError as e:
+                    logging.error('Stopping the crawl early: %s', e)
+        finally:
+            pages.close()
+            if pool:
+                pool.close()
+                pool.join()
+
+        # Stopping short (e.g. on a failed page) keeps the checkpoint around
+        if complete:
+            checkpoint.finish()
 
         return all_records
 
+    def _iter_pages_until_failure(self, pages):
+        """ The pages of iter_record_pages, ending quietly at a failed page """
+        try:
+            for offset, page_records in pages:
+                yield page_records
+        except PageFetchError as e:
+            logging.error('Stopping the crawl early: %s', e)
+        finally:
+            pages.close()
+
     def download_historical_loan_data(self):
+        """ Download and parse the historical loan stats.
+
+        Returns: dict of loan id -> loan data
+        """
+        loan_chunks = self.iter_historical_loan_data()[0]
+
+        id_to_loan_data = {}
+        for chunk in loan_chunks:
+            id_to_loan_data.update(chunk)
+        return id_to_loan_data
+
+    def iter_historical_loan_data(self, chunk_size=LOAN_CHUNK_SIZE,
+                                  cache_dir=None):
+        """ Download the historical loan stats, parsing them as they
+        arrive, in chunks (see iter_loan_data_chunks).
+
+        The response is streamed straight into the parser, decompressed on
+        the fly if it is gzipped or zipped; the next chunk is parsed in a
+        background thread while the caller handles the current one.
+
+        With a cache_dir, the latest complete copy of the CSV is kept there,
+        and the download is conditional on the file's ETag / Last-Modified
+        when it was last committed: the caller calls commit() once the loans
+        are safely stored, and only then are they remembered.
+
+        Returns: (generator of dicts of loan id -> loan data, commit), or
+            None if the file hasn't changed since the last committed
+            download to cache_dir
+        """
+        validators_path = None
+        headers = {'Accept-Encoding': 'gzip'}
+        if cache_dir:
+            validators_path = os.path.join(cache_dir,
+                                           LOAN_DATA_VALIDATORS_FILENAME)
+            headers.update(load_validators(validators_path, LOAN_DATA_CSV_URL))
+
         logging.info('Downloading file from %s..', LOAN_DATA_CSV_URL)
-        urlretrieve(LOAN_DATA_CSV_URL, LOAN_DATA_CSV_TMPFILE)
-        logging.info('Done writing to %s', LOAN_DATA_CSV_TMPFILE)
-        return parse_loan_data_from_file(LOAN_DATA_CSV_TMPFILE)
+        self.rate_limiter.before_request()
+        try:
+            response = self.download_opener.open(
+                Request(LOAN_DATA_CSV_URL, headers=headers), timeout=TIMEOUT)
+        except HTTPError as e:
+            if e.code == 304:
+                logging.info('%s has not changed since the last download',
+                             LOAN_DATA_CSV_URL)
+                return None
+            raise
+
+        cache_path = None
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, LOAN_DATA_CACHE_FILENAME)
+        download = {'complete': False}
+
+        def commit():
+            """ Remember this download, so the next one is conditional on it """
+            if not download['complete']:
+                raise ValueError('the loan data was not read to the end')
+            if validators_path:
+                save_validators(validators_path, LOAN_DATA_CSV_URL,
+                                response.info(), cache_file=cache_path)
+
+        loan_chunks = self._iter_loan_data_response(response, chunk_size,
+                                                    cache_path, download)
+        return loan_chunks, commit
+
+    def _iter_loan_data_response(self, response, chunk_size, cache_path,
+                                 download):
+        blocks = iter_decoded(iter_blocks(response),
+                              response.info().getheader('Content-Encoding'))
+
+        cache_file = None
+        if cache_path:
+            # Replaces the previous copy only once this one is complete
+            tmp_cache_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            cache_file = open(tmp_cache_path, 'wb')
+            blocks = tee(blocks, cache_file)
+
+        try:
+            for chunk in prefetch(iter_loan_data_chunks(iter_lines(blocks),
+                                                        chunk_size), depth=1):
+                yield chunk
+            download['complete'] = True
+        finally:
+            response.close()
+            if cache_file:
+                cache_file.close()
+                if download['complete']:
+                    os.rename(tmp_cache_path, cache_path)
+                else:
+                    os.remove(tmp_cache_path)
+
+        logging.info('Done downloading %s', LOAN_DATA_CSV_URL)
+        if cache_file:
+            logging.info('Kept a copy in %s', cache_path)
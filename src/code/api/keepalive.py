@@ -0,0 +1,126 @@
+""" Persistent HTTPS connections for urllib2
+
+urllib2's stock HTTPSHandler opens (and TLS-handshakes) a new connection
+for every request. KeepAliveHTTPSHandler keeps a small pool of idle
+connections per host and reuses them, asks for gzip-compressed bodies,
+and counts how often connections are reused.
+
+It only replaces the transport: cookie, redirect and error handling still
+happen in the usual urllib2 handlers, so an opener built with
+HTTPCookieProcessor(cookie_jar) keeps sharing that jar.
+
+Response bodies are read in full before the connection goes back to the
+pool, so the returned response objects are in-memory copies.
+"""
+import httplib
+import socket
+import threading
+import zlib
+
+from StringIO import StringIO
+from urllib import addinfourl
+from urllib2 import HTTPSHandler, URLError
+
+DEFAULT_POOL_SIZE = 8   # idle connections kept per host
+
+
+class KeepAliveHTTPSHandler(HTTPSHandler):
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, debuglevel=0):
+        HTTPSHandler.__init__(self, debuglevel=debuglevel)
+        self.pool_size = pool_size
+        self.idle_connections = {}  # host -> [HTTPSConnection]
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'new_connections': 0,
+            'reused_connections': 0,
+            'stale_retries': 0,
+            'bytes_received': 0,
+            'bytes_decoded': 0,
+        }
+
+    def _count(self, **increments):
+        with self.lock:
+            for name, value in increments.iteritems():
+                self.counters[name] += value
+
+    def _get_connection(self, host, timeout):
+        with self.lock:
+            connections = self.idle_connections.get(host)
+            if connections:
+                return connections.pop(), True
+
+        connection = httplib.HTTPSConnection(host, timeout=timeout)
+        connection.set_debuglevel(self._debuglevel)
+        return connection, False
+
+    def _release_connection(self, host, connection):
+        with self.lock:
+            connections = self.idle_connections.setdefault(host, [])
+            if len(connections) < self.pool_size:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle_connections.itervalues():
+                for connection in connections:
+                    connection.close()
+            self.idle_connections = {}
+
+    def https_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers['Accept-Encoding'] = 'gzip'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        while True:
+            connection, reused = self._get_connection(host, req.timeout)
+            try:
+                connection.request(req.get_method(), req.get_selector(),
+                                   req.data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException) as err:
+                connection.close()
+                if reused:
+                    # The server dropped an idle connection; try a fresh one
+                    self._count(stale_retries=1)
+                    continue
+                raise URLError(err)
+            break
+
+        self._count(requests=1,
+                    reused_connections=1 if reused else 0,
+                    new_connections=0 if reused else 1,
+                    bytes_received=len(body))
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(host, connection)
+
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            del response.msg['content-encoding']
+        self._count(bytes_decoded=len(body))
+
+        resp = addinfourl(StringIO(body), response.msg,
+                          req.get_full_url(), response.status)
+        resp.msg = response.reason
+        return resp
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
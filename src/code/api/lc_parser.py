@@ -2,23 +2,69 @@ from HTMLParser import HTMLParser
 
 import re
 
+from memoize import intern_string, lru_memoize
+
+# Start tags of the page regions each parser reads. Everything before the
+# first of them is skipped without tokenizing it.
+NOTE_SECTIONS_RE = re.compile(
+    r'<(?:table|div)\b[^>]*\bid\s*=\s*["\']?'
+    r'(?:trend-data|lcLoanPerf1|lcLoanPerfTable2)\b', re.I)
+LOAN_SECTIONS_RE = re.compile(
+    r'<table\b[^>]*\bclass\s*=\s*["\']?loan-details\b', re.I)
+
+
+class _StopParsing(Exception):
+    """ Raised from a handler once every region of interest is consumed """
+    pass
+
+
+def _feed_regions(parser, page, sections_re, fast):
+    """ Feed page to parser. With fast=True, start at the first region of
+    interest and let the parser stop early by raising _StopParsing.
+    """
+    if fast:
+        match = sections_re.search(page)
+        page = page[match.start():] if match else ''
+    try:
+        parser.feed(page)
+    except _StopParsing:
+        pass
+
+
+# Collection messages are mapped to the label of the first pattern they match
+MESSAGE_PATTERNS = [
+    (re.compile(r'no message left|no voicemail'), 'no message left'),
+    (re.compile(r'message left|left voicemail'), 'message left'),
+    (re.compile(r'legal action'), 'legal action'),
+    (re.compile(r'Initial payment reminder|email sent|[Ss]ent email'),
+     'payment reminder'),
+    (re.compile(r'[Bb]orrower (contacted|informed) | promised | agreed'),
+     'borrower agreed'),
+]
+MESSAGE_CACHE_SIZE = 4096
+
+@lru_memoize(maxsize=MESSAGE_CACHE_SIZE)
 def map_message(data):
-    if (re.search(r'no message left|no voicemail', data)):
-        return 'no message left'
-    elif (re.search(r'message left|left voicemail', data)):
-        return 'message left'
-    elif (re.search(r'legal action', data)):
-        return 'legal action'
-    elif (re.search(r'Initial payment reminder|email sent|[Ss]ent email', data)):
-        return 'payment reminder'
-    elif (re.search(r'[Bb]orrower (contacted|informed) | promised | agreed', data)):
-        return 'borrower agreed'
-    else:
-        return data
+    for pattern, label in MESSAGE_PATTERNS:
+        if pattern.search(data):
+            return label
+    return intern_string(data)
 
 class NoteHTMLParser(HTMLParser):
-    def __init__(self, page):
+    """ Extracts the credit, payment and contact history of a note page.
+
+    With fast=True (the default) only the trend-data, lcLoanPerf1 and
+    lcLoanPerfTable2 regions are tokenized: parsing starts at the first of
+    them and stops once all three have been read. fast=False parses the
+    whole page; get_info() is the same either way.
+    """
+
+    SECTIONS = (1, 2, 3)
+
+    def __init__(self, page, fast=True):
         HTMLParser.__init__(self)
+        self.fast = fast
+        self.sections_done = set()
         self.stage = 0
         self.scores = []
         self.dates = []
@@ -27,13 +73,19 @@ class NoteHTMLParser(HTMLParser):
         self.status = []
         self.contact_dates = []
         self.messages = []
-        self.feed(page)
+        _feed_regions(self, page, NOTE_SECTIONS_RE, fast)
+
+    def _section_done(self, section):
+        self.stage = 0
+        if self.fast:
+            self.sections_done.add(section)
+            if len(self.sections_done) == len(self.SECTIONS):
+                raise _StopParsing()
 
     def handle_starttag(self, tag, attrs):
         if (self.stage == 0 and tag == "table"):
-            for attr in attrs:
-                if (attr[0] == "id" and attr[1] == "trend-data"):
-                    self.stage = 1
+            if ("id", "trend-data") in attrs:
+                self.stage = 1
         elif (self.stage == 1 and tag == "tbody"):
             self.stage = 11
         elif (self.stage == 11 and tag == "tr"):
@@ -42,23 +94,20 @@ class NoteHTMLParser(HTMLParser):
             self.stage = self.stage + 1
 
         if (self.stage == 0 and tag == "div"):
-            for attr in attrs:
-                if (attr[0] == "id" and attr[1] == "lcLoanPerf1"):
-                    self.stage = 2
+            if ("id", "lcLoanPerf1") in attrs:
+                self.stage = 2
         elif (self.stage == 2 and tag == "tbody"):
             self.stage = 21
         elif (self.stage == 21 and tag == "tr"):
             self.stage = 210
-            for attr in attrs:
-                if (attr[0] == "style" and attr[1] == "display: none;"):
-                    self.stage = 21
+            if ("style", "display: none;") in attrs:
+                self.stage = 21
         elif (self.stage >= 210 and self.stage <= 228): # assume tag == "td", but may have other info
             self.stage = self.stage + 1
 
         if (self.stage == 0 and tag == "table"):
-            for attr in attrs:
-                if (attr[0] == "id" and attr[1] == "lcLoanPerfTable2"):
-                    self.stage = 3
+            if ("id", "lcLoanPerfTable2") in attrs:
+                self.stage = 3
         elif (self.stage == 3 and tag == "tbody"):
             self.stage = 31
         elif (self.stage == 31 and tag == "tr"):
@@ -92,19 +141,19 @@ class NoteHTMLParser(HTMLParser):
         elif (self.stage == 114 and tag == "tr"):
             self.stage = 11
         elif (self.stage == 11 and tag == "tbody"):
-            self.stage = 0
+            self._section_done(1)
 
         elif (self.stage >= 211 and self.stage <= 229 and tag == "td"):
             self.stage = self.stage + 1
         elif (self.stage == 230 and tag == "tr"):
             self.stage = 21
         elif (self.stage == 21 and tag == "tbody"):
-            self.stage = 0
+            self._section_done(2)
 
         elif (self.stage == 314 and tag == "tr"):
             self.stage = 31
         elif (self.stage == 31 and tag == "tbody"):
-            self.stage = 0
+            self._section_done(3)
 
     def get_info(self):
         result = True
@@ -134,18 +183,30 @@ class NoteHTMLParser(HTMLParser):
         return history
 
 class LoanHTMLParser(HTMLParser):
-    def __init__(self, page):
+    """ Extracts the loan details, borrower profile and credit history of a
+    loan page.
+
+    With fast=True (the default) parsing starts at the loan-details table
+    and stops once the profile and credit history tables have been read.
+    fast=False parses the whole page; get_info() is the same either way.
+    """
+
+    # stage reached when each table closes
+    SECTION_END_STAGES = (22, 47, 66)
+
+    def __init__(self, page, fast=True):
         HTMLParser.__init__(self)
+        self.fast = fast
+        self.sections_done = set()
         self.stage = 0
         self.loan_details = {}
         self.profile = {}
         self.credit = {}
-        self.feed(page)
+        _feed_regions(self, page, LOAN_SECTIONS_RE, fast)
     def handle_starttag(self, tag, attrs):
         if (self.stage == 0 and tag == "table"):
-            for attr in attrs:
-                if (attr[0] == "class" and attr[1] == "loan-details"):
-                    self.stage = 1
+            if ("class", "loan-details") in attrs:
+                self.stage = 1
         elif (self.stage == 3 and tag == "h3"):
             for attr in attrs:
                 if (attr[0] == "class" and attr[1] == "profile_title master_pngfix"):
@@ -255,8 +316,13 @@ class LoanHTMLParser(HTMLParser):
             self.stage = self.stage / 100 + 1
             
     def handle_endtag(self, tag):
-        if ((self.stage == 22 or self.stage == 47 or self.stage == 66) and tag == "table"):
+        if (self.stage in self.SECTION_END_STAGES and tag == "table"):
+            if self.fast:
+                self.sections_done.add(self.stage)
             self.stage = 3
+            if (self.fast and
+                    len(self.sections_done) == len(self.SECTION_END_STAGES)):
+                raise _StopParsing()
 
     def get_info(self):
         result = True
@@ -272,6 +338,14 @@ class LoanHTMLParser(HTMLParser):
         info['result'] = result
         return info
 
+def parse_note_page(page):
+    """ Module-level entry point, so it can run in a multiprocessing pool """
+    return NoteHTMLParser(page).get_info()
+
+def parse_loan_page(page):
+    """ Module-level entry point, so it can run in a multiprocessing pool """
+    return LoanHTMLParser(page).get_info()
+
 if __name__ == '__main__':
     import urllib
     loan_page = urllib.urlopen("loan.html").read()
@@ -0,0 +1,128 @@
+""" Bounded memoization for normalizing repetitive strings
+
+Loan statuses and collection messages come from a small vocabulary but
+are seen hundreds of thousands of times, so their normalizers are
+memoized on the raw string:
+
+    @lru_memoize(maxsize=1024)
+    def parse_loan_status(loan_status):
+        ...
+
+    parse_loan_status.cache.stats()   # hits, misses, hit rate, size
+    parse_loan_status.cache.log_stats('loan_status')
+
+The cache keeps the maxsize most recently used results, so an unexpected
+stream of distinct strings can't grow it without bound.
+"""
+import functools
+import logging
+import threading
+
+DEFAULT_MAXSIZE = 1024
+
+
+def intern_string(value):
+    """ intern() str results so equal results share one object; other
+    values (None, unicode) are returned as they are """
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+# Fields of a link in the LRUCache's list
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """ Results of fn for its maxsize most recently used arguments.
+
+    Entries are kept in a dict and in a circular doubly linked list in
+    order of use (as in Python 3's functools.lru_cache), so a hit only
+    relinks one entry.
+    """
+
+    def __init__(self, fn, maxsize=DEFAULT_MAXSIZE):
+        self.fn = fn
+        self.maxsize = maxsize
+        self.entries = {}   # key -> link
+        self.root = []      # the list's sentinel
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key):
+        root = self.root
+        with self.lock:
+            link = self.entries.get(key)
+            if link is not None:
+                # Move the link to the most recently used end
+                link_prev, link_next, key, value = link
+                link_prev[NEXT] = link_next
+                link_next[PREV] = link_prev
+                last = root[PREV]
+                last[NEXT] = root[PREV] = link
+                link[PREV] = last
+                link[NEXT] = root
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = self.fn(key)
+
+        with self.lock:
+            if key in self.entries:
+                return value    # another thread added it meanwhile
+            if len(self.entries) >= self.maxsize:
+                oldest = root[NEXT]
+                root[NEXT] = oldest[NEXT]
+                oldest[NEXT][PREV] = root
+                del self.entries[oldest[KEY]]
+            last = root[PREV]
+            link = [last, root, key, value]
+            last[NEXT] = root[PREV] = self.entries[key] = link
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+            }
+
+    def log_stats(self, name):
+        """ Log stats() at debug level, e.g. once at the end of a run """
+        stats = self.stats()
+        logging.debug("%s cache: %d hits, %d misses (%.1f%% hit rate), "
+                      "%d of %d entries", name, stats['hits'], stats['misses'],
+                      stats['hit_rate'] * 100, stats['size'], stats['maxsize'])
+
+
+def lru_memoize(maxsize=DEFAULT_MAXSIZE):
+    """ Memoize a function of one hashable argument in an LRUCache. The
+    cache (with its stats()) is the wrapper's `cache` attribute and the
+    original function its `uncached` attribute. """
+
+    def decorate(fn):
+        cache = LRUCache(fn, maxsize)
+
+        @functools.wraps(fn)
+        def wrapper(key):
+            return cache(key)
+
+        wrapper.cache = cache
+        wrapper.uncached = fn
+        return wrapper
+
+    return decorate
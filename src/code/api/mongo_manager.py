@@ -1,5 +1,9 @@
+from pymongo import ASCENDING
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from pymongo.errors import OperationFailure
 
+import hashlib
 import time
 import logging
 import pprint
@@ -11,18 +15,261 @@ MONGO_HOST = 'localhost'
 MONGO_PORT = 27017
 MONGO_DBNAME = 'lendingclub'
 UPDATE_ERROR_CRITICAL_THRESHOLD = 10  # Threshold for CRITICAL log entry
+BULK_WRITE_CHUNK_SIZE = 1000  # orders prefetched and written per round trip
+PENDING_RECORDS_BATCH_SIZE = 1000  # pending record ids fetched per query
+
+# Error codes of a write that would duplicate a unique index key
+DUPLICATE_KEY_ERROR_CODES = (11000, 11001)
+
+LOANS_STAGING_COLLECTION = 'loans_staging'
+LOAN_HASH_FIELD = 'content_hash'
+
+# Indexes to create on each collection, as (keys, index options)
+INDEXES = {
+    'orders': [
+        ([('noteId', ASCENDING), ('loanGUID', ASCENDING),
+          ('orderId', ASCENDING)], {'unique': True}),
+        ([('first_seen', ASCENDING)], {}),
+        ([('last_seen', ASCENDING)], {}),
+    ],
+    'loans': [
+        ([('loanGUID', ASCENDING)], {}),
+    ],
+    'records': [
+        ([('note_id', ASCENDING)], {'unique': True}),
+        ([('downloaded', ASCENDING), ('note_id', ASCENDING)], {}),
+    ],
+    'notedetails': [
+        ([('note_id', ASCENDING)], {'unique': True}),
+    ],
+}
+
+# Representative query of each MongoManager method, for the index report
+QUERY_SHAPES = [
+    ('update_order_from_dict', 'orders',
+     {'noteId': 0, 'loanGUID': 0, 'orderId': 0}),
+    ('bulk_update_orders', 'orders', {'noteId': {'$in': [0, 1]}}),
+    ('get_market_volumes', 'orders', {'first_seen': {'$gte': 0, '$lt': 1}}),
+    ('get_market_volumes', 'orders', {'last_seen': {'$gte': 0, '$lt': 1}}),
+    ('sync_loans', 'loans', {'loanGUID': 0}),
+    ('iter_pending_records', 'records',
+     {'downloaded': False, 'note_id': {'$gt': 0}}),
+    ('add_note_details', 'records', {'note_id': {'$in': [0, 1]}}),
+    ('add_note_details', 'notedetails', {'note_id': 0}),
+    ('add_note_ids', 'records', {'note_id': 0}),
+]
+
+# (noteId, loanGUID, orderId) identifies an order
+ORDER_KEY_FIELDS = ('noteId', 'loanGUID', 'orderId')
+
+# Assume these fields do not change over time for (order, note, loan)
+ORDER_CONST_FIELDS = ['loanGrade', 'loanRate', 'loanClass']
 
 
 class NoteConstantFieldsChangedError(ValueError):
     pass
 
 
+def order_key(order):
+    return tuple(order[f] for f in ORDER_KEY_FIELDS)
+
+
+def merge_order(existing_order, order_data, update_time):
+    """ Build the document to store for order_data, seen at update_time,
+    given the currently stored version of the order (or None).
+
+    Raises: NoteConstantFieldsChangedError if a field that should never
+        change for an order has changed
+    """
+
+    new_order = order_data.copy()
+
+    if existing_order:
+        # UPDATE: preserve _id, first_seen, and price_history
+        if '_id' in existing_order:
+            new_order['_id'] = existing_order['_id']
+        new_order['first_seen'] = existing_order['first_seen']
+        new_order['price_history'] = \
+            list(existing_order.get('price_history', []))
+
+        # Sanity check: constant fields should not change
+        if any(existing_order[f] != order_data[f] for f in ORDER_CONST_FIELDS):
+
+            # If they have, log a detailed error and skip the write
+            error_msg = (
+                'Constant fields on an order have changed!\n' +
+                'Note Info URL:%s\n' % build_note_info_url(
+                    order_data['noteId'],
+                    order_data['loanGUID'],
+                    order_data['orderId']) +
+                'Mismatching records: \n%s\n%s\n' % (
+                    pprint.pformat(existing_order),
+                    pprint.pformat(order_data)) +
+                'Skipping write.')
+
+            raise NoteConstantFieldsChangedError(error_msg)
+
+    else:
+        # CREATE: initialize a new order's first_seen and price_history
+        new_order['first_seen'] = update_time
+        new_order['price_history'] = []
+
+    # update last_seen and price_history for all orders
+    new_order['last_seen'] = update_time
+    new_order['price_history'].append(
+        [new_order['asking_price'], update_time])
+
+    new_order['price_history'] = \
+        consolidate_price_history(new_order['price_history'])
+
+    return new_order
+
+
+def order_update(existing_order, new_order):
+    """ Update operators that turn the stored existing_order into
+    new_order (as built by merge_order), touching only what changed.
+
+    Returns: (update, touch_index). When the only changes are last_seen and
+        the time of the last price_history point (the price hasn't moved),
+        update is None and touch_index is the index of that point, so the
+        write can be batched with other unchanged orders.
+    """
+    to_set = {}
+    to_unset = {}
+    for field, value in new_order.iteritems():
+        if field in ('_id', 'last_seen', 'price_history'):
+            continue
+        if field not in existing_order or existing_order[field] != value:
+            to_set[field] = value
+    for field in existing_order:
+        if field not in new_order:
+            to_unset[field] = ''
+
+    old_history = existing_order.get('price_history', [])
+    new_history = new_order['price_history']
+    last = len(new_history) - 1
+    touch_index = None
+    update = {}
+
+    if len(old_history) == len(new_history) and \
+            old_history[:-1] == new_history[:-1]:
+        if old_history[-1][0] == new_history[-1][0]:
+            # Same price: consolidation just moved the last point forward
+            touch_index = last
+        else:
+            to_set['price_history.%d' % last] = new_history[-1]
+    elif old_history == new_history[:-1]:
+        update['$push'] = {'price_history': new_history[-1]}
+    else:
+        to_set['price_history'] = new_history
+
+    if touch_index is not None and not to_set and not to_unset:
+        return None, touch_index
+
+    if touch_index is not None:
+        to_set['price_history.%d.1' % touch_index] = new_history[-1][1]
+    to_set['last_seen'] = new_order['last_seen']
+    update['$set'] = to_set
+    if to_unset:
+        update['$unset'] = to_unset
+    return update, None
+
+
+def loan_hash(loan):
+    """ Fingerprint of a parsed loan record, ignoring bookkeeping fields """
+    content = sorted((k, v) for k, v in loan.iteritems()
+                     if k not in ('_id', 'last_updated', LOAN_HASH_FIELD))
+    return hashlib.sha1(repr(content)).hexdigest()
+
+
+def aggregate(collection, pipeline):
+    """ Run an aggregation and return its documents as a list.
+    pymongo 2 returns the raw command result, pymongo 3 a cursor.
+    """
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
+
+
+def describe_plan(explain):
+    """ One-line summary of an explain() result, e.g.
+    'FETCH <- IXSCAN first_seen_1' or 'COLLSCAN'
+    """
+    if 'cursor' in explain:
+        # MongoDB < 3.0: 'BasicCursor' or 'BtreeCursor <index name>'
+        return explain['cursor']
+
+    stages = []
+    plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    while plan:
+        stage = plan.get('stage', '?')
+        if 'indexName' in plan:
+            stage += ' ' + plan['indexName']
+        stages.append(stage)
+        plan = plan.get('inputStage')
+    return ' <- '.join(stages)
+
+
+def format_record_ids(document):
+    """ records documents -> the keys Downloader.fetch_record_detail uses """
+    return {
+        'orderId': document['order_id'],
+        'noteId': document['note_id'],
+        'loanGUID': document['loan_id'],
+    }
+
+
+def note_id_query(shard_index=0, shard_count=1, start_after=None):
+    """ Condition on note_id selecting one shard of the note ids,
+    optionally only those after start_after """
+    query = {}
+    if shard_count > 1:
+        query['$mod'] = [shard_count, shard_index]
+    if start_after is not None:
+        query['$gt'] = start_after
+    return query
+
+
+def iter_chunks(pages, chunk_size):
+    """ Regroup the values of a stream of dicts into lists of chunk_size """
+    chunk = []
+    for page in pages:
+        for item in page.itervalues():
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
 class MongoManager(object):
-    def __init__(self, host=MONGO_HOST, port=MONGO_PORT, dbname=MONGO_DBNAME):
+    def __init__(self, host=MONGO_HOST, port=MONGO_PORT, dbname=MONGO_DBNAME,
+                 ensure_indexes=True):
         self.client = MongoClient(host, port)
         self.db = self.client[dbname]
 
-    def update_loans(self, all_loans):
+        if ensure_indexes:
+            self.ensure_indexes()
+
+    def update_loans(self, all_loans, incremental=False):
+        return self.update_loan_chunks([all_loans], incremental=incremental)
+
+    def update_loan_chunks(self, loan_chunks, incremental=False):
+        """ Replace the loans collection with loans that arrive as a stream
+        of chunks (dicts of loan id -> loan, see iter_loan_data_chunks),
+        writing each chunk with one bulk insert as soon as it arrives.
+
+        With incremental=True the collection is synced instead (see
+        sync_loans).
+
+        Returns: number of loans written
+        """
+
+        if incremental:
+            counts = self.sync_loans(loan_chunks)
+            return counts['inserted'] + counts['updated']
 
         logging.info("Dropping all of the existing loan records")
         self.db.loans.remove({})
@@ -30,15 +277,122 @@ class MongoManager(object):
         update_time = time.time()
 
         counter = 0
-        for loan_id, loan in all_loans.iteritems():
-            loan['last_updated'] = update_time
-            self.db.loans.insert(loan)
+        seen_loan_ids = set()
+        for chunk in loan_chunks:
+            if not chunk:
+                continue
+
+            bulk = self.db.loans.initialize_unordered_bulk_op()
+            for loan_id, loan in chunk.iteritems():
+                loan['last_updated'] = update_time
+                if loan_id in seen_loan_ids:
+                    # Repeated from an earlier chunk: the later row wins
+                    bulk.find({'loanGUID': loan['loanGUID']}).replace_one(loan)
+                else:
+                    seen_loan_ids.add(loan_id)
+                    bulk.insert(loan)
+            bulk.execute()
+
+            counter += len(chunk)
+            logging.debug(".. wrote %s records", counter)
+
+        return counter
+
+    def sync_loans(self, loan_chunks):
+        """ Bring the loans collection in line with the loans in
+        loan_chunks (dicts of loan id -> loan), writing only the loans whose
+        content hash changed and removing vanished loans.
+
+        The changes are applied to a copy of the collection, which then
+        replaces `loans` in a single rename, so readers see either the old
+        or the new generation and never a half-written one.
+
+        Returns: dict of counts of inserted/updated/unchanged/removed loans
+        """
 
-            counter += 1
-            if counter % 5000 == 0:
-                logging.debug(".. wrote %s records", counter)
+        update_time = time.time()
 
-    def update_orders(self, all_orders):
+        stored_hashes = dict(
+            (loan['loanGUID'], loan.get(LOAN_HASH_FIELD))
+            for loan in self.db.loans.find(
+                {}, {'loanGUID': 1, LOAN_HASH_FIELD: 1}))
+        logging.info("Found %s stored loans", len(stored_hashes))
+
+        # Copy the current generation server-side, then patch the copy
+        staging = self.db[LOANS_STAGING_COLLECTION]
+        staging.drop()
+        self.db.loans.aggregate([{'$out': LOANS_STAGING_COLLECTION}])
+        # $out doesn't copy indexes, and the rename drops those of `loans`
+        self.ensure_collection_indexes('loans', staging)
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        seen_loan_ids = set()
+        bulk = staging.initialize_unordered_bulk_op()
+        pending = 0
+
+        for loan_id, loan in (item for chunk in loan_chunks
+                              for item in chunk.iteritems()):
+            guid = loan['loanGUID']
+            repeated = guid in seen_loan_ids
+            seen_loan_ids.add(guid)
+
+            content_hash = loan_hash(loan)
+            if not repeated and stored_hashes.get(guid, False) == content_hash:
+                counts['unchanged'] += 1
+                continue
+
+            if repeated and pending:
+                # Unordered writes to the same loan could land in any order
+                bulk.execute()
+                bulk = staging.initialize_unordered_bulk_op()
+                pending = 0
+
+            counts['updated' if guid in stored_hashes else 'inserted'] += 1
+            loan[LOAN_HASH_FIELD] = content_hash
+            loan['last_updated'] = update_time
+            bulk.find({'loanGUID': guid}).upsert().replace_one(loan)
+            pending += 1
+
+            if pending >= BULK_WRITE_CHUNK_SIZE:
+                bulk.execute()
+                bulk = staging.initialize_unordered_bulk_op()
+                pending = 0
+                logging.debug(".. wrote %s records",
+                              counts['inserted'] + counts['updated'])
+
+        vanished_ids = [loan_guid for loan_guid in stored_hashes
+                        if loan_guid not in seen_loan_ids]
+        for i in xrange(0, len(vanished_ids), BULK_WRITE_CHUNK_SIZE):
+            bulk.find({'loanGUID': {
+                '$in': vanished_ids[i:i + BULK_WRITE_CHUNK_SIZE]}}).remove()
+            pending += 1
+        counts['removed'] = len(vanished_ids)
+
+        if pending:
+            bulk.execute()
+
+        # Atomically replace the old generation
+        staging.rename('loans', dropTarget=True)
+
+        logging.info("Synced loans: %(inserted)s inserted, %(updated)s "
+                     "updated, %(unchanged)s unchanged, %(removed)s removed",
+                     counts)
+        return counts
+
+    def update_orders(self, all_orders, delta=False):
+        return self.update_order_pages([all_orders], delta=delta)
+
+    def update_order_pages(self, pages, delta=False):
+        """ Write a market snapshot that arrives as a stream of pages
+        (dicts of order_id -> order), holding only one chunk of orders
+        (BULK_WRITE_CHUNK_SIZE) in memory at a time.
+
+        Every order in the snapshot is stamped with the same update_time.
+        With delta=True, stored orders are updated in place rather than
+        rewritten (see bulk_update_orders).
+
+        Returns: number of orders written
+        """
 
         logging.info("Writing to MongoDB")
 
@@ -46,16 +400,19 @@ class MongoManager(object):
 
         orders_updated = 0
         error_count = 0
-        for order_id, order in all_orders.iteritems():
-            try:
-                self.update_order_from_dict(order, update_time)
-                orders_updated += 1
-            except NoteConstantFieldsChangedError as e:
-                logging.warning(e.message)
-                error_count += 1
+        start_time = time.time()
+        for chunk in iter_chunks(pages, BULK_WRITE_CHUNK_SIZE):
+            chunk_updated, chunk_errors = self.bulk_update_orders(
+                chunk, update_time, delta=delta)
+            orders_updated += chunk_updated
+            error_count += chunk_errors
+
+            logging.debug(".. wrote %s records", orders_updated)
 
-            if orders_updated % 5000 == 0:
-                logging.debug(".. wrote %s records", orders_updated)
+        elapsed = time.time() - start_time
+        logging.info("Wrote %s orders in %.1fs (%.0f orders/sec)",
+                     orders_updated, elapsed,
+                     orders_updated / elapsed if elapsed else 0)
 
         if error_count > UPDATE_ERROR_CRITICAL_THRESHOLD:
             # Send an email if too many errors occured
@@ -64,108 +421,306 @@ class MongoManager(object):
                 "There were %d errors updating orders.",
                 UPDATE_ERROR_CRITICAL_THRESHOLD, error_count)
 
-    def update_order_from_dict(self, order_data, update_time):
+        return orders_updated
 
-        # Assume these fields do not change over time for (order, note, loan)
-        const_fields = ['loanGrade', 'loanRate', 'loanClass']
+    def update_order_from_dict(self, order_data, update_time):
 
-        existing_order = self.db.orders.find_one({
-            'noteId': order_data['noteId'],
-            'loanGUID': order_data['loanGUID'],
-            'orderId': order_data['orderId'],
-            })
+        existing_order = self.db.orders.find_one(
+            dict(zip(ORDER_KEY_FIELDS, order_key(order_data))))
 
-        new_order = order_data.copy()
+        self.db.orders.save(merge_order(existing_order, order_data, update_time))
 
-        if existing_order:
-            # UPDATE: preserve _id, first_seen, and price_history
-            new_order['_id'] = existing_order['_id']
-            new_order['first_seen'] = existing_order['first_seen']
-            new_order['price_history'] = \
-                existing_order.get('price_history', [])
-
-            # Sanity check: constant fields should not change
-            if any(existing_order[f] != order_data[f] for f in const_fields):
-
-                # If they have, log a detailed error and skip the write
-                error_msg = (
-                    'Constant fields on an order have changed!\n' +
-                    'Note Info URL:%s\n' % build_note_info_url(
-                        order_data['noteId'],
-                        order_data['loanGUID'],
-                        order_data['orderId']) +
-                    'Mismatching records: \n%s\n%s\n' % (
-                        pprint.pformat(existing_order),
-                        pprint.pformat(order_data)) +
-                    'Skipping write.')
-
-                raise NoteConstantFieldsChangedError(error_msg)
+    def bulk_update_orders(self, orders, update_time, delta=False):
+        """ Same as calling update_order_from_dict on each order, but with
+        one query to prefetch the existing orders and one unordered bulk
+        write for the whole list.
 
-        else:
-            # CREATE: initialize a new order's first_seen and price_history
-            new_order['first_seen'] = update_time
-            new_order['price_history'] = []
+        With delta=True, stored orders are not replaced: each one is
+        compared with its prefetched version and only the changed fields
+        are written (see order_update). Orders whose price hasn't moved
+        only need last_seen bumped, which is done with one multi-document
+        update per price_history length.
 
-        # update last_seen and price_history for all orders
-        new_order['last_seen'] = update_time
-        new_order['price_history'].append(
-            [new_order['asking_price'], update_time])
+        Returns: (orders written, orders skipped because of errors)
+        """
 
-        new_order['price_history'] = \
-            consolidate_price_history(new_order['price_history'])
+        existing_orders = {}
+        for existing_order in self.db.orders.find(
+                {'noteId': {'$in': list(set(o['noteId'] for o in orders))}}):
+            existing_orders[order_key(existing_order)] = existing_order
 
-        self.db.orders.save(new_order)
+        # Merge in memory; a repeated order builds on its earlier version
+        pending = {}
+        error_count = 0
+        for order_data in orders:
+            key = order_key(order_data)
+            try:
+                new_order = merge_order(
+                    pending.get(key) or existing_orders.get(key),
+                    order_data, update_time)
+            except NoteConstantFieldsChangedError as e:
+                logging.warning(e.message)
+                error_count += 1
+                continue
+            pending[key] = new_order
+
+        if not pending:
+            return 0, error_count
+
+        bulk = self.db.orders.initialize_unordered_bulk_op()
+        touched = {}    # price_history index -> _ids of unchanged orders
+        for key, new_order in pending.iteritems():
+            if '_id' not in new_order:
+                bulk.insert(new_order)
+            elif not delta:
+                bulk.find({'_id': new_order['_id']}).replace_one(new_order)
+            else:
+                update, touch_index = order_update(existing_orders[key],
+                                                   new_order)
+                if update:
+                    bulk.find({'_id': new_order['_id']}).update_one(update)
+                else:
+                    touched.setdefault(touch_index, []).append(new_order['_id'])
+
+        for touch_index, ids in touched.iteritems():
+            bulk.find({'_id': {'$in': ids}}).update({'$set': {
+                'last_seen': update_time,
+                'price_history.%d.1' % touch_index: update_time,
+            }})
+
+        if touched:
+            logging.debug("%d of %d orders unchanged but for last_seen",
+                          sum(len(ids) for ids in touched.itervalues()),
+                          len(pending))
+
+        orders_written = len(pending)
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            logging.warning("%d of %d order writes failed: %s",
+                            len(write_errors), orders_written, write_errors[:1])
+            orders_written -= len(write_errors)
+            error_count += len(write_errors)
+
+        return orders_written, error_count
 
     def get_all_orders(self):
         return list(self.db.orders.find({}))
 
+    def ensure_indexes(self):
+        """ Create the indexes declared in INDEXES (a no-op if they exist).
+        An index that can't be built, e.g. a unique index over existing
+        duplicates, is logged and skipped.
+        """
+        for collection_name in INDEXES:
+            self.ensure_collection_indexes(collection_name)
+
+    def ensure_collection_indexes(self, collection_name, collection=None):
+        """ Create the indexes INDEXES declares for collection_name, on that
+        collection or on `collection`, e.g. a copy that will replace it """
+        if collection is None:
+            collection = self.db[collection_name]
+        for keys, options in INDEXES[collection_name]:
+            try:
+                collection.create_index(keys, **options)
+            except OperationFailure as e:
+                logging.warning("Could not create index %s on %s: %s",
+                                keys, collection.name, e)
+
+    def index_usage_report(self):
+        """ How each method's query is executed, plus per-index access
+        counts where the server supports $indexStats (MongoDB 3.2+).
+
+        Returns: list of report lines
+        """
+        lines = []
+        for method, collection_name, query in QUERY_SHAPES:
+            plan = describe_plan(
+                self.db[collection_name].find(query).explain())
+            lines.append('%s (%s): %s' % (method, collection_name, plan))
+
+        for collection_name in sorted(INDEXES):
+            try:
+                stats = aggregate(self.db[collection_name],
+                                  [{'$indexStats': {}}])
+            except OperationFailure:
+                continue
+            for index in stats:
+                lines.append('%s.%s: %s accesses' % (
+                    collection_name, index['name'], index['accesses']['ops']))
+
+        return lines
+
+    def count_orders_by_bucket(self, field, start_time, bucket_count,
+                               interval_sec):
+        """ Count orders whose `field` timestamp falls into each of
+        bucket_count consecutive intervals starting at start_time, in a
+        single aggregation.
+
+        Returns: dict of bucket index -> count, omitting empty buckets
+        """
+        end_time = start_time + bucket_count * interval_sec
+        offset = {'$subtract': ['$' + field, start_time]}
+        pipeline = [
+            {'$match': {field: {'$gte': start_time, '$lt': end_time}}},
+            {'$project': {'offset': offset}},
+            {'$group': {
+                '_id': {'$subtract': [
+                    '$offset', {'$mod': ['$offset', interval_sec]}]},
+                'count': {'$sum': 1},
+            }},
+        ]
+
+        return dict((int(round(bucket['_id'] / interval_sec)), bucket['count'])
+                    for bucket in aggregate(self.db.orders, pipeline))
+
     def get_market_volumes(self, start_time, end_time, interval_sec=60*60):
+        """ Number of orders added (first seen) and removed (last seen)
+        in each interval_sec-long period between start_time and end_time.
+        Incomplete trailing periods are left out.
+        """
 
-        volume_buckets = []
+        bucket_count = int((end_time - start_time) // interval_sec)
+        if bucket_count <= 0:
+            return []
 
-        while start_time + interval_sec <= end_time:
-            records_added_in_time_period = self.db.orders.find(
-                {'$and': [
-                    {'first_seen': {'$gte': start_time}},
-                    {'first_seen': {'$lt': start_time + interval_sec}},
-                ]}).count()
-            records_removed_in_time_period = self.db.orders.find(
-                {'$and': [
-                    {'last_seen': {'$gte': start_time}},
-                    {'last_seen': {'$lt': start_time + interval_sec}},
-                ]}).count()
+        added = self.count_orders_by_bucket(
+            'first_seen', start_time, bucket_count, interval_sec)
+        removed = self.count_orders_by_bucket(
+            'last_seen', start_time, bucket_count, interval_sec)
+
+        volume_buckets = []
+        for i in xrange(bucket_count):
+            period_start = start_time + i * interval_sec
             volume_buckets.append({
-                'records_added': records_added_in_time_period,
-                'records_removed': records_removed_in_time_period,
-                'period_start': start_time,
-                'period_end': start_time + interval_sec,
+                'records_added': added.get(i, 0),
+                'records_removed': removed.get(i, 0),
+                'period_start': period_start,
+                'period_end': period_start + interval_sec,
             })
 
-            start_time += interval_sec
-
         return volume_buckets
-  
+
     def get_records(self, update=True):
+        if update:  # only those not downloaded yet
+            return dict(self.iter_pending_records())
+
         cursor = self.db.records.find()
         all_record_ids = {}
         for document in cursor:
-            record_ids = {}
-            record_ids['orderId'] = document['order_id']
-            record_ids['noteId'] = document['note_id']
-            record_ids['loanGUID'] = document['loan_id']
-            all_record_ids[document['note_id']] = record_ids
-
-        if update:  # filter out those already downloaded
-            cursor = self.db.notedetails.find()
-            for document in cursor:
-                all_record_ids.pop(document['note_id'], None)
+            all_record_ids[document['note_id']] = format_record_ids(document)
 
         return all_record_ids
 
+    def backfill_downloaded_flags(self):
+        """ Set the `downloaded` flag on records stored before it existed,
+        using the note details that are already in notedetails.
+        """
+        if not self.db.records.find_one({'downloaded': {'$exists': False}}):
+            return
+
+        logging.info("Backfilling the downloaded flag on records")
+        self.db.records.update({'downloaded': {'$exists': False}},
+                               {'$set': {'downloaded': False}}, multi=True)
+
+        note_ids = []
+        for document in self.db.notedetails.find({}, {'note_id': 1}):
+            note_ids.append(document['note_id'])
+            if len(note_ids) >= PENDING_RECORDS_BATCH_SIZE:
+                self.mark_downloaded(note_ids)
+                note_ids = []
+        self.mark_downloaded(note_ids)
+
+    def count_pending_records(self, shard_index=0, shard_count=1):
+        query = {'downloaded': False}
+        note_ids = note_id_query(shard_index, shard_count)
+        if note_ids:
+            query['note_id'] = note_ids
+        return self.db.records.find(query).count()
+
+    def iter_pending_records(self, batch_size=PENDING_RECORDS_BATCH_SIZE,
+                             start_after=None, shard_index=0, shard_count=1):
+        """ Lazily yield (note_id, record_ids) for records whose details
+        have not been downloaded, in note_id order, optionally only those
+        after the note_id start_after.
+
+        With shard_count > 1, only yields the note ids that are equal to
+        shard_index modulo shard_count.
+
+        Pages through the (downloaded, note_id) index by note_id instead of
+        holding one long-lived cursor, so slow consumers can't time it out.
+        """
+        query = {'downloaded': False}
+        note_ids = note_id_query(shard_index, shard_count, start_after)
+        if note_ids:
+            query['note_id'] = note_ids
+        while True:
+            batch = list(self.db.records.find(
+                query, {'note_id': 1, 'order_id': 1, 'loan_id': 1})
+                .sort('note_id', ASCENDING).limit(batch_size))
+            if not batch:
+                return
+
+            for document in batch:
+                yield document['note_id'], format_record_ids(document)
+
+            query['note_id'] = note_id_query(shard_index, shard_count,
+                                             batch[-1]['note_id'])
+
+    def mark_downloaded(self, note_ids):
+        if note_ids:
+            self.db.records.update({'note_id': {'$in': list(note_ids)}},
+                                   {'$set': {'downloaded': True}}, multi=True)
+
     def add_note_details(self, page_record_details):
-        for note_id, record_details in page_record_details.iteritems():
-             self.db.notedetails.insert(record_details)
+        """ Store note details, replacing any already stored for the same
+        note_id (e.g. fetched by another shard) """
+        if not page_record_details:
+            return
+        self.upsert_by_note_id(self.db.notedetails, [
+            (note_id, 'replace_one', record_details)
+            for note_id, record_details in page_record_details.iteritems()])
+        self.mark_downloaded(page_record_details.keys())
 
     def add_note_ids(self, page_record_ids):
+        """ Store record ids, one per note_id. A record that is already
+        stored keeps its downloaded flag. """
+        if not page_record_ids:
+            return
+        writes = []
         for note_id, record_ids in page_record_ids.iteritems():
-             self.db.records.insert(record_ids)
+            record_ids = dict(record_ids)
+            downloaded = record_ids.pop('downloaded', False)
+            writes.append((note_id, 'update', {
+                '$set': record_ids,
+                '$setOnInsert': {'downloaded': downloaded},
+            }))
+        self.upsert_by_note_id(self.db.records, writes)
+
+    def upsert_by_note_id(self, collection, writes):
+        """ Apply writes, a list of (note_id, method, document) where method
+        is 'replace_one' or 'update', as upserts on note_id in one unordered
+        bulk op.
+
+        note_id is unique, so when another shard inserts the same note_id
+        between our upsert's lookup and its insert, the upsert fails with a
+        duplicate key error instead of storing a second copy. Those writes
+        are retried once, which updates the other shard's document.
+        """
+        for attempt in xrange(2):
+            bulk = collection.initialize_unordered_bulk_op()
+            for note_id, method, document in writes:
+                getattr(bulk.find({'note_id': note_id}).upsert(), method)(document)
+            try:
+                bulk.execute()
+                return
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                if attempt or not write_errors or any(
+                        error['code'] not in DUPLICATE_KEY_ERROR_CODES
+                        for error in write_errors):
+                    raise
+                logging.debug("Retrying %d upserts on %s that raced another "
+                              "shard", len(write_errors), collection.name)
+                writes = [writes[error['index']] for error in write_errors]
@@ -0,0 +1,131 @@
+""" Small building blocks for overlapping crawl stages
+
+prefetch() runs a producer (e.g. a page fetcher) in a background thread
+BackgroundConsumer runs a sink (e.g. a mongo writer) in a background thread
+
+Both are joined to the caller by bounded queues, so a fast stage blocks
+instead of buffering without limit (backpressure). Exceptions raised in a
+background stage are re-raised in the caller's thread.
+"""
+import logging
+import sys
+import threading
+
+from Queue import Queue, Full
+
+DEFAULT_QUEUE_DEPTH = 4
+PUT_POLL_INTERVAL = 0.1     # seconds
+
+_DONE = object()
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def _put_unless_stopped(queue, item, stop):
+    """ Blocking put that gives up once `stop` is set """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=PUT_POLL_INTERVAL)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def prefetch(iterable, depth=DEFAULT_QUEUE_DEPTH):
+    """ Iterate `iterable` in a background thread, keeping up to `depth`
+    items ready ahead of the consumer.
+
+    Closing the returned generator early stops the producer at its next put.
+    """
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put_unless_stopped(queue, item, stop):
+                    return
+        except Exception:
+            _put_unless_stopped(queue, _Failure(sys.exc_info()), stop)
+        else:
+            _put_unless_stopped(queue, _DONE, stop)
+
+    producer = threading.Thread(target=produce, name='prefetch')
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                item.reraise()
+            yield item
+    finally:
+        stop.set()
+
+
+class BackgroundConsumer(object):
+    """ Calls `consume(item)` for every item put(), in a background thread.
+
+    Usage:
+        with BackgroundConsumer(mongo_manager.add_note_details) as writer:
+            for page in pages:
+                writer.put(page)
+    """
+
+    def __init__(self, consume, depth=DEFAULT_QUEUE_DEPTH, name='consumer'):
+        self.consume = consume
+        self.queue = Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.failure = None
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            try:
+                self.consume(item)
+            except Exception:
+                logging.exception('Background consumer failed')
+                self.failure = _Failure(sys.exc_info())
+                self.stop.set()
+                return
+
+    def _check(self):
+        if self.failure:
+            self.failure.reraise()
+
+    def put(self, item):
+        self._check()
+        _put_unless_stopped(self.queue, item, self.stop)
+        self._check()
+
+    def close(self):
+        """ Wait for queued items to be consumed """
+        _put_unless_stopped(self.queue, _DONE, self.stop)
+        self.thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't mask the original error; just let the thread wind down
+            _put_unless_stopped(self.queue, _DONE, self.stop)
+        return False
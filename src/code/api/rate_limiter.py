@@ -0,0 +1,194 @@
+""" Request throttling for the Downloader
+
+A RateLimiter combines three pieces:
+    TokenBucket - keeps the request rate under a target requests-per-second
+    ExponentialBackoff - how long to wait before retrying a failed request
+    CircuitBreaker - stops hammering the site after repeated failures
+
+It also keeps counters for time spent throttled, backing off and on the
+wire, so crawls can report where their wall clock went.
+"""
+import random
+import threading
+import time
+
+# The old random 0-1s nap averaged two requests per second
+DEFAULT_MAX_RPS = 2.0
+DEFAULT_BURST = 1
+
+BACKOFF_BASE = 1.0      # seconds
+BACKOFF_CAP = 60.0      # seconds
+
+BREAKER_FAILURE_THRESHOLD = 10  # consecutive failures before opening
+BREAKER_RESET_TIMEOUT = 300     # seconds before letting a trial through
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """ Classic token bucket: tokens refill at `rate` per second up to
+    `capacity`, and each request consumes one.
+    """
+
+    def __init__(self, rate, capacity=DEFAULT_BURST):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, sleeping until one is available.
+
+        Returns: seconds spent waiting
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+            # Reserve the token now; a negative balance is a queue of
+            # callers that will be served in order as tokens refill.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class ExponentialBackoff(object):
+    """ Exponential backoff with "full jitter": the delay for attempt n is
+    drawn uniformly from [0, min(cap, base * 2^(n-1))].
+    """
+
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_CAP, jitter=True):
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        ceiling = min(self.cap, self.base * 2 ** (attempt - 1))
+        if self.jitter:
+            return random.uniform(0, ceiling)
+        return ceiling
+
+
+class CircuitBreaker(object):
+    """ Opens after `failure_threshold` consecutive failures. While open,
+    requests fail fast; after `reset_timeout` seconds a single trial request
+    is let through, and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if (not self.trial_in_flight and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        """ Returns: True if this failure opened the circuit """
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.trial_in_flight or (
+                    self.opened_at is None and
+                    self.consecutive_failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self.trial_in_flight = False
+                return True
+            return False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class RateLimiter(object):
+    """ Pluggable throttling policy used by Downloader.open_url.
+
+    Args:
+        max_rps (float): target requests per second; None disables throttling
+        backoff (ExponentialBackoff): retry delay policy
+        breaker (CircuitBreaker): fail-fast policy
+    """
+
+    def __init__(self, max_rps=DEFAULT_MAX_RPS, burst=DEFAULT_BURST,
+                 backoff=None, breaker=None):
+        self.bucket = TokenBucket(max_rps, burst) if max_rps else None
+        self.backoff = backoff or ExponentialBackoff()
+        self.breaker = breaker or CircuitBreaker()
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.throttled_time = 0.0
+        self.backoff_time = 0.0
+        self.wire_time = 0.0
+
+    def before_request(self):
+        """ Wait for a request slot.
+
+        Raises: CircuitOpenError if the circuit breaker is open
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(
+                'circuit open after %d consecutive failures' %
+                self.breaker.consecutive_failures)
+
+        if self.bucket:
+            waited = self.bucket.acquire()
+            with self.lock:
+                self.throttled_time += waited
+
+    def record_success(self, elapsed):
+        self.breaker.record_success()
+        with self.lock:
+            self.requests += 1
+            self.wire_time += elapsed
+
+    def record_failure(self, elapsed):
+        """ Returns: True if this failure opened the circuit """
+        with self.lock:
+            self.requests += 1
+            self.failures += 1
+            self.wire_time += elapsed
+        return self.breaker.record_failure()
+
+    def wait_before_retry(self, attempt):
+        """ Sleep for the backoff delay of the given (1-based) retry """
+        delay = self.backoff.delay(attempt)
+        time.sleep(delay)
+        with self.lock:
+            self.backoff_time += delay
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'throttled_time': self.throttled_time,
+                'backoff_time': self.backoff_time,
+                'wire_time': self.wire_time,
+                'circuit_open': self.breaker.is_open(),
+            }
@@ -5,6 +5,9 @@ import time
 import logging
 
 from lc_logging import init_logging
+from archive import ResponseArchive
+from checkpoint import FileCheckpointStore, MongoCheckpointStore
+from coordinator import ShardedCrawl
 from downloader import Downloader
 from mongo_manager import MongoManager
 
@@ -27,19 +30,78 @@ def weka_friendly(record):
 
 
 def write_csv(data_dict, filename):
-    list_of_records = data_dict.values()
-    if not data_dict or len(data_dict) == 0:
-        logging.warning('No data to write!')
+    for page in iter_pages_written_to_csv([data_dict], filename):
+        pass
+
 
+def iter_pages_written_to_csv(pages, filename):
+    """ Pass pages (dicts of id -> record) through unchanged, appending
+    their records to a CSV file on the way. The header is taken from the
+    first record; fields that only appear in later records are dropped.
+    """
     with open(filename, 'wb') as f:
-        writer = csv.DictWriter(f, list_of_records[0].viewkeys(),
-                                quoting=csv.QUOTE_NONNUMERIC)
-        writer.writeheader()
-        for record in list_of_records:
-            try:
-                writer.writerow(weka_friendly(record))
-            except UnicodeEncodeError:
-                logging.warning('Skipping a CSV row because unicode is hard')
+        writer = None
+        for page in pages:
+            for record in page.itervalues():
+                if writer is None:
+                    writer = csv.DictWriter(f, record.keys(),
+                                            quoting=csv.QUOTE_NONNUMERIC,
+                                            extrasaction='ignore')
+                    writer.writeheader()
+                try:
+                    # weka_friendly edits in place; leave the page intact
+                    writer.writerow(weka_friendly(dict(record)))
+                except UnicodeEncodeError:
+                    logging.warning('Skipping a CSV row because unicode is hard')
+            yield page
+
+    if writer is None:
+        logging.warning('No data to write!')
+
+
+def downloader_options(args):
+    """ Downloader arguments other than the credentials """
+    return dict(debug=args.debug,
+                max_rps=args.max_rps,
+                parse_workers=args.parse_workers,
+                archive=ResponseArchive(args.archive) if args.archive else None,
+                replay=args.replay,
+                replay_as_of=args.replay_as_of,
+                pool_size=args.pool_size)
+
+
+def build_downloader(args):
+    return Downloader(username=args.username,
+                      password=args.password,
+                      **downloader_options(args))
+
+
+def load_accounts(args):
+    """ Accounts to crawl with: those in --authfile, if given, otherwise
+    just --username. The first account also fills in a missing --username.
+    """
+    if not args.authfile:
+        return [(args.username, args.password)]
+
+    # staticconf is only needed for authfiles
+    import auth
+    auth.load_authfile(args.authfile)
+    accounts = auth.load_accounts()
+    if accounts and not args.username:
+        args.username, args.password = accounts[0]
+    return accounts or [(args.username, args.password)]
+
+
+def sharded_crawl(args, accounts):
+    return ShardedCrawl(accounts, downloader_options(args),
+                        checkpoint_file=args.checkpoint_file)
+
+
+def checkpoint_store(args, mongo_manager):
+    """ Checkpoints go to --checkpoint-file if given, otherwise to mongo """
+    if args.checkpoint_file:
+        return FileCheckpointStore(args.checkpoint_file)
+    return MongoCheckpointStore(mongo_manager.db)
 
 
 def parse_commandline_args():
@@ -57,11 +119,40 @@ def parse_commandline_args():
         '--username', metavar='u', type=str)
     arg_parser.add_argument(
         '--password', metavar='P', type=str)
+    arg_parser.add_argument(
+        '--authfile', metavar='y', type=str, default=None)
     arg_parser.add_argument(
         '--action', metavar='a', type=str, default='update_orders')
     arg_parser.add_argument('--debug', action='store_true')
+    arg_parser.add_argument('--stream', action='store_true')
+    arg_parser.add_argument('--incremental', action='store_true')
+    arg_parser.add_argument('--delta', action='store_true')
+    arg_parser.add_argument(
+        '--loan-chunk-size', metavar='l', type=int, default=5000)
+    arg_parser.add_argument(
+        '--cache-dir', metavar='D', type=str, default=None)
+    arg_parser.add_argument(
+        '--interval', metavar='s', type=int, default=60*60)
+    arg_parser.add_argument('--resume', action='store_true')
+    arg_parser.add_argument(
+        '--checkpoint-file', metavar='k', type=str, default=None)
     arg_parser.add_argument('--skip-db', action='store_true')
     arg_parser.add_argument('--download-details', type=bool, default=False)
+    arg_parser.add_argument(
+        '--workers', metavar='w', type=int, default=1)
+    arg_parser.add_argument(
+        '--max-rps', metavar='r', type=float, default=None)
+    arg_parser.add_argument(
+        '--prefetch-pages', metavar='f', type=int, default=4)
+    arg_parser.add_argument(
+        '--parse-workers', metavar='x', type=int, default=0)
+    arg_parser.add_argument(
+        '--archive', metavar='A', type=str, default=None)
+    arg_parser.add_argument('--replay', action='store_true')
+    arg_parser.add_argument(
+        '--pool-size', metavar='C', type=int, default=8)
+    arg_parser.add_argument(
+        '--replay-as-of', metavar='t', type=float, default=None)
 
     return arg_parser.parse_args()
 
@@ -74,41 +165,95 @@ def run():
     logging.info(' ---------- ')
     logging.info(' started downloader with action: %s', args.action)
     logging.info(' ---------- ')
-    
-    if args.action == "download_notes":
-        mm = MongoManager()
-        downloader = Downloader(username=args.username,
-                                password=args.password,
-                                debug=args.debug)
 
-        downloader.download_data(
+    accounts = load_accounts(args)
+
+    if args.action == "download_notes" and len(accounts) > 1:
+        # One process per account, each crawling its share of the pages
+        sharded_crawl(args, accounts).run(
+            'download_data',
             max_records=args.max_records,
             pagesize=args.page_size,
-            mongo_manager=mm,
-            download_details=args.download_details)
+            download_details=args.download_details,
+            workers=args.workers,
+            prefetch_pages=args.prefetch_pages,
+            resume=args.resume)
+
+    elif args.action == "download_notes":
+        # The Downloader (and its parse pool) before MongoClient's threads
+        downloader = build_downloader(args)
+        try:
+            mm = MongoManager()
+            downloader.download_data(
+                max_records=args.max_records,
+                pagesize=args.page_size,
+                mongo_manager=mm,
+                download_details=args.download_details,
+                workers=args.workers,
+                prefetch_pages=args.prefetch_pages,
+                checkpoint_store=checkpoint_store(args, mm),
+                resume=args.resume)
+        finally:
+            downloader.close()
+
+    elif args.action == "download_note_details" and len(accounts) > 1:
+        sharded_crawl(args, accounts).run(
+            'download_note_details',
+            pagesize=args.page_size,
+            workers=args.workers,
+            resume=args.resume)
 
     elif args.action == "download_note_details":
-        mm = MongoManager()
-        downloader = Downloader(username=args.username,
-                                password=args.password,
-                                debug=args.debug)
+        downloader = build_downloader(args)
+        try:
+            mm = MongoManager()
+            downloader.download_note_details(mm, pagesize=args.page_size,
+                                             workers=args.workers,
+                                             checkpoint_store=checkpoint_store(args, mm),
+                                             resume=args.resume)
+        finally:
+            downloader.close()
 
-        downloader.download_note_details(mm, pagesize=args.page_size)
+    elif args.action == "update_orders" and args.stream:
+        downloader = build_downloader(args)
+        try:
+            # Pages flow from the site to the CSV and mongo one at a time
+            pages = downloader.download_data(
+                max_records=args.max_records,
+                pagesize=args.page_size,
+                prefetch_pages=args.prefetch_pages,
+                stream=True)
 
-    elif args.action == "update_orders":
-        downloader = Downloader(username=args.username,
-                                password=args.password,
-                                debug=args.debug)
+            if args.filename:
+                pages = iter_pages_written_to_csv(pages, args.filename)
 
-        orders = downloader.download_data(
-            max_records=args.max_records,
-            pagesize=args.page_size)
+            if not args.skip_db:
+                mm = MongoManager()
+                orders_updated = mm.update_order_pages(pages, delta=args.delta)
+                logging.info('%s orders updated in mongo', orders_updated)
+            else:
+                logging.info('%s records fetched', sum(len(page) for page in pages))
+        finally:
+            downloader.close()
+
+        if args.filename:
+            logging.info('finished writing to %s', args.filename)
+
+    elif args.action == "update_orders":
+        downloader = build_downloader(args)
+        try:
+            orders = downloader.download_data(
+                max_records=args.max_records,
+                pagesize=args.page_size,
+                prefetch_pages=args.prefetch_pages)
+        finally:
+            downloader.close()
 
         logging.info('%s records fetched', len(orders))
 
         if not args.skip_db:
             mm = MongoManager()
-            mm.update_orders(orders)
+            mm.update_orders(orders, delta=args.delta)
             logging.info('%s orders updated in mongo', len(orders))
         
         if args.filename:
@@ -117,18 +262,33 @@ def run():
 
     elif args.action == "update_loans":
         downloader = Downloader()
-        loans = downloader.download_historical_loan_data()
-    
-        if not args.skip_db:
-            mm = MongoManager()
-            mm.update_loans(loans)
-            logging.info('%s loans updated in mongo', len(loans))
+        try:
+            download = downloader.iter_historical_loan_data(
+                chunk_size=args.loan_chunk_size, cache_dir=args.cache_dir)
+
+            if download is None:
+                logging.info('Loan data unchanged, nothing to update')
+            elif not args.skip_db:
+                loan_chunks, commit_download = download
+                mm = MongoManager()
+                loans_updated = mm.update_loan_chunks(
+                    loan_chunks, incremental=args.incremental)
+                logging.info('%s loans updated in mongo', loans_updated)
+                # Only now can the next run skip an unchanged file
+                commit_download()
+            else:
+                # Not committed: mongo still needs this data
+                loan_chunks, commit_download = download
+                logging.info('%s loans parsed',
+                             sum(len(chunk) for chunk in loan_chunks))
+        finally:
+            downloader.close()
 
     elif args.action == "show_volumes":
         mm = MongoManager()
         start = time.time() - 2*7*24*60*60  # show last two weeks of data
         end = time.time() - 60*60  # omit the last hour
-        volumes = mm.get_market_volumes(start, end)
+        volumes = mm.get_market_volumes(start, end, interval_sec=args.interval)
         for v in volumes:
             mytime = datetime.datetime.fromtimestamp(v['period_start']).ctime()
 
@@ -136,6 +296,12 @@ def run():
                 mytime,
                 v['records_added'],
                 v['records_removed'])
+
+    elif args.action == "ensure_indexes":
+        mm = MongoManager(ensure_indexes=False)
+        mm.ensure_indexes()
+        for line in mm.index_usage_report():
+            print line
     else:
         logging.error('unknown action: %s', args.action)
 
@@ -0,0 +1,91 @@
+""" Health of a logged-in Lending Club session
+
+Rather than fetching the account summary page to check that we're still
+logged in, SessionHealth works from what we already have:
+    - when we logged in, and when the session cookies expire
+    - the responses themselves: a redirect to the login page means the
+      session is gone
+
+Every successful login starts a new session generation. A worker that
+sees a logged-out response calls renew() with the generation its request
+was made under; if other workers saw the same dead session at the same
+time, only the first logs in again and the rest reuse its session.
+"""
+import logging
+import threading
+import time
+
+SESSION_COOKIE_DOMAIN = 'lendingclub.com'
+LOGIN_PAGE_MARKER = '/account/login'
+
+DEFAULT_MAX_SESSION_AGE = 2 * 60 * 60   # seconds
+COOKIE_EXPIRY_MARGIN = 60               # renew this many seconds early
+
+
+class SessionHealth(object):
+
+    def __init__(self, cookie_jar, max_age=DEFAULT_MAX_SESSION_AGE,
+                 domain=SESSION_COOKIE_DOMAIN):
+        self.cookie_jar = cookie_jar
+        self.max_age = max_age
+        self.domain = domain
+        self.generation = 0
+        self.logged_in_at = None
+        self.renewals = 0
+        self.renew_lock = threading.Lock()
+
+    def mark_logged_in(self):
+        self.logged_in_at = time.time()
+        self.generation += 1
+
+    def mark_logged_out(self):
+        self.logged_in_at = None
+
+    def age(self):
+        """ Seconds since we logged in, or None if we aren't """
+        if self.logged_in_at is None:
+            return None
+        return time.time() - self.logged_in_at
+
+    def cookie_expiry(self):
+        """ Earliest expiry time of the site's persistent cookies, or None
+        if there are only session cookies """
+        expiries = [cookie.expires for cookie in self.cookie_jar
+                    if cookie.expires and
+                    cookie.domain.lstrip('.').endswith(self.domain)]
+        return min(expiries) if expiries else None
+
+    def needs_renewal(self):
+        """ True if we're logged in, but the session is too old or its
+        cookies are about to expire """
+        age = self.age()
+        if age is None:
+            return False
+        if age > self.max_age:
+            return True
+        expiry = self.cookie_expiry()
+        return expiry is not None and \
+            expiry - COOKIE_EXPIRY_MARGIN < time.time()
+
+    def is_logged_out_response(self, response):
+        """ True if response ended up on the login page """
+        try:
+            return LOGIN_PAGE_MARKER in response.geturl()
+        except AttributeError:
+            return False
+
+    def renew(self, generation, login):
+        """ Call login() to start a new session, unless the session has
+        already been renewed since `generation`.
+
+        Returns: the result of login(), or True if someone else renewed it
+        """
+        with self.renew_lock:
+            if self.generation != generation:
+                logging.debug('Session already renewed by another worker')
+                return True
+
+            self.renewals += 1
+            logging.info('Session is no longer valid (age %s), logging in again',
+                         '%.0fs' % self.age() if self.logged_in_at else 'unknown')
+            return login()
@@ -0,0 +1,177 @@
+""" Streaming a large download straight into a parser
+
+Rather than saving a file to disk and reading it back, the response is
+read in blocks, decompressed on the fly if it is gzipped or zipped,
+optionally copied to a file on the way, and split into lines, e.g. for
+csv.reader:
+
+    lines = iter_lines(iter_decoded(iter_blocks(response)))
+
+The validators of a download (ETag / Last-Modified) can be kept in a small
+JSON file, to make the next request for it conditional.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+READ_BLOCK_SIZE = 64 * 1024
+
+GZIP_MAGIC = '\x1f\x8b'
+ZIP_MAGIC = 'PK\x03\x04'
+ZIP_HEADER = struct.Struct('<4s5H3L2H')    # zip local file header
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def iter_blocks(response, block_size=READ_BLOCK_SIZE):
+    while True:
+        block = response.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def iter_gunzipped(blocks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for block in blocks:
+        data = decompressor.decompress(block)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def iter_unzipped(blocks):
+    """ Contents of the first file in a zip archive, read front to back
+    (zipfile needs to seek to the central directory at the end) """
+    blocks = iter(blocks)
+    buf = ''
+
+    def read_to(size, buf):
+        while len(buf) < size:
+            block = next(blocks, None)
+            if block is None:
+                raise ValueError('truncated zip file')
+            buf += block
+        return buf
+
+    buf = read_to(ZIP_HEADER.size, buf)
+    (signature, version, flags, method, mod_time, mod_date, crc,
+     compressed_size, size, name_length, extra_length) = \
+        ZIP_HEADER.unpack(buf[:ZIP_HEADER.size])
+    header_length = ZIP_HEADER.size + name_length + extra_length
+    buf = read_to(header_length, buf)[header_length:]
+
+    if method == ZIP_DEFLATED:
+        # A deflate stream marks its own end; anything after it is zip
+        # bookkeeping (data descriptor, other files, central directory)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        pending = [buf]
+        while True:
+            for block in pending:
+                data = decompressor.decompress(block)
+                if data:
+                    yield data
+                if decompressor.unused_data:
+                    return
+            block = next(blocks, None)
+            if block is None:
+                break
+            pending = [block]
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    elif method == ZIP_STORED and not flags & ZIP_DATA_DESCRIPTOR_FLAG:
+        remaining = compressed_size
+        block = buf
+        while remaining > 0 and block is not None:
+            yield block[:remaining]
+            remaining -= len(block)
+            block = next(blocks, None)
+
+    else:
+        raise ValueError('unsupported zip compression method %d' % method)
+
+
+def iter_decoded(blocks, content_encoding=None):
+    """ Decode a gzip Content-Encoding, then unpack the body itself if it
+    is a gzip or zip file """
+    if content_encoding and content_encoding.lower() == 'gzip':
+        blocks = iter_gunzipped(blocks)
+
+    blocks = iter(blocks)
+    first = next(blocks, '')
+
+    def rest():
+        yield first
+        for block in blocks:
+            yield block
+
+    if first.startswith(GZIP_MAGIC):
+        logging.debug('Decompressing a gzip download')
+        return iter_gunzipped(rest())
+    if first.startswith(ZIP_MAGIC):
+        logging.debug('Unpacking a zip download')
+        return iter_unzipped(rest())
+    return rest()
+
+
+def iter_lines(blocks):
+    """ Split blocks of text into lines, keeping the line endings """
+    pending = ''
+    for block in blocks:
+        lines = (pending + block).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def tee(blocks, f):
+    """ Pass blocks through, writing each one to the file f """
+    for block in blocks:
+        f.write(block)
+        yield block
+
+
+def load_validators(path, url):
+    """ Request headers that make a request for url conditional on it
+    having changed since the download recorded in path """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        validators = json.load(f).get(url, {})
+
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def save_validators(path, url, response_headers, **extra):
+    """ Record the ETag / Last-Modified of a completed download of url """
+    validators = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            validators = json.load(f)
+
+    entry = dict(extra)
+    entry['etag'] = response_headers.getheader('ETag')
+    entry['last_modified'] = response_headers.getheader('Last-Modified')
+    validators[url] = entry
+
+    # Write a temp file and rename it, so a crash never leaves half a file
+    tmp_path = '%s.%d.%s.tmp' % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    with open(tmp_path, 'w') as f:
+        json.dump(validators, f)
+    os.rename(tmp_path, path)